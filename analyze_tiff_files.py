@@ -6,6 +6,7 @@ Checks if TIFFs are GeoTIFFs with coordinate reference system (CRS) and bounds.
 
 import os
 from pathlib import Path
+from optimize_geotiffs import find_tiff_files
 
 def check_dependencies():
     """Check if required libraries are available."""
@@ -83,6 +84,8 @@ def analyze_with_rasterio(file_path):
             print(f"  📐 Dimensions: {src.width} x {src.height} pixels")
             print(f"  📊 Bands: {src.count}")
             print(f"  🔢 Data type: {src.dtypes[0]}")
+            compression = src.compression.value if src.compression else "none"
+            print(f"  🧱 Blocks: {src.block_shapes[0]}, compression: {compression}, overviews: {src.overviews(1)}")
             
             # Coordinate Reference System
             if src.crs:
@@ -162,7 +165,8 @@ def main():
         print("Please run the rename script first to extract the TIFF files.")
         return
     
-    tiff_files = list(tiff_dir.glob("*.tiff")) + list(tiff_dir.glob("*.tif"))
+    # Optimized copies from optimize_geotiffs.py are used where available
+    tiff_files = find_tiff_files(tiff_dir)
     
     if not tiff_files:
         print(f"No TIFF files found in {tiff_dir}")
@@ -171,7 +175,7 @@ def main():
     print(f"\nFound {len(tiff_files)} TIFF files:")
     print("-" * 50)
     
-    for i, tiff_file in enumerate(sorted(tiff_files), 1):
+    for i, tiff_file in enumerate(tiff_files, 1):
         print(f"\n{i}. {tiff_file.name}")
         print("   " + "=" * (len(tiff_file.name) + 3))
         
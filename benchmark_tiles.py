@@ -0,0 +1,321 @@
+#!/usr/bin/env python3
+"""
+Benchmark for the XYZ tiler on synthetic GeoTIFFs.
+
+Synthetic rasters of several sizes, dtypes and nodata fractions are
+generated at run time (tiled, DEFLATE-compressed, with overviews, like the
+output of optimize_geotiffs.py). Each raster is then tiled one zoom level at
+a time by create_tiles_for_geotiff, each run in a fresh process. For every
+zoom the benchmark reports tiles per second, the time spent in each stage
+(read, normalize, resize, encode, write) and the peak RSS, written as JSON:
+    python benchmark_tiles.py --output baseline.json
+
+With --baseline, results are compared against an earlier run. Cases whose
+throughput drops or whose peak RSS grows by more than --threshold are
+flagged, and the script exits with status 1:
+    python benchmark_tiles.py --baseline baseline.json --output current.json
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import resource
+import tempfile
+import contextlib
+import multiprocessing
+from pathlib import Path
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+# Synthetic rasters sit on the island in UTM zone 40S with 10 m pixels,
+# the Sentinel-2 resolution
+SYNTHETIC_CRS = "EPSG:32740"
+SYNTHETIC_ORIGIN = (540000.0, 7790000.0)
+SYNTHETIC_PIXEL_SIZE = 10.0
+
+# Stage timings collected by create_tiles_for_geotiff, in report order
+STAGES = ("read", "normalize", "resize", "encode", "write")
+
+# Fractional change beyond which a case is flagged as a regression
+REGRESSION_THRESHOLD = 0.10
+
+def case_name(size, dtype, nodata_fraction):
+    """Return the label identifying a synthetic raster in results and baselines."""
+    return f"{size}px/{dtype}/nodata{round(nodata_fraction * 100)}%"
+
+def synthetic_values(rows, cols, row_off, size, dtype, rng):
+    """Return a smooth field with some noise for rows [row_off, row_off + rows) of a raster."""
+    y, x = np.mgrid[row_off:row_off + rows, 0:cols].astype(np.float32) / size
+    field = 0.5 + 0.25 * np.sin(x * 17) * np.cos(y * 13) + 0.2 * np.sin((x + y) * 41)
+    field += rng.normal(0, 0.03, field.shape).astype(np.float32)
+    np.clip(field, 0, 1, out=field)
+    
+    dtype = np.dtype(dtype)
+    if np.issubdtype(dtype, np.integer):
+        # Keep 0 free as the nodata value
+        return (1 + field * (np.iinfo(dtype).max - 1)).astype(dtype)
+    return (field * 1.2 - 0.2).astype(dtype)
+
+def nodata_mask(size, nodata_fraction, rng):
+    """Return a (size, size) mask with clumped nodata areas covering about nodata_fraction."""
+    if nodata_fraction <= 0:
+        return None
+    # Coarse noise cells blown up to full size give cloud- and sea-like patches
+    coarse = rng.random((max(4, size // 256), max(4, size // 256)))
+    coarse_mask = coarse < np.quantile(coarse, nodata_fraction)
+    scale = -(-size // coarse.shape[0])
+    return coarse_mask.repeat(scale, axis=0).repeat(scale, axis=1)[:size, :size]
+
+def create_synthetic_geotiff(path, size, dtype, nodata_fraction, seed=0):
+    """Write a size x size synthetic GeoTIFF with overviews and return its path."""
+    import rasterio
+    from rasterio.transform import from_origin
+    from create_tile_server import ensure_overviews
+    
+    rng = np.random.default_rng(seed)
+    mask = nodata_mask(size, nodata_fraction, rng)
+    is_float = np.issubdtype(np.dtype(dtype), np.floating)
+    profile = {
+        'driver': 'GTiff',
+        'width': size,
+        'height': size,
+        'count': 1,
+        'dtype': dtype,
+        'crs': SYNTHETIC_CRS,
+        'transform': from_origin(*SYNTHETIC_ORIGIN, SYNTHETIC_PIXEL_SIZE, SYNTHETIC_PIXEL_SIZE),
+        'nodata': np.nan if is_float else 0,
+        'tiled': True,
+        'blockxsize': 512,
+        'blockysize': 512,
+        'compress': 'deflate',
+    }
+    
+    # Written in strips so large rasters never sit in memory whole
+    with rasterio.open(path, 'w', **profile) as dst:
+        for row_off in range(0, size, 512):
+            rows = min(512, size - row_off)
+            data = synthetic_values(rows, size, row_off, size, dtype, rng)
+            if mask is not None:
+                data[mask[row_off:row_off + rows]] = profile['nodata']
+            dst.write(data, 1, window=rasterio.windows.Window(0, row_off, size, rows))
+    
+    ensure_overviews(path)
+    return Path(path)
+
+def peak_rss_mb():
+    """Return the peak resident set size of this process and its children in MB."""
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+def run_zoom(geotiff_path, zoom, settings):
+    """Tile one zoom level of a GeoTIFF and return its measurements.
+    
+    Runs in its own process, so peak RSS covers this zoom level only.
+    """
+    from create_tile_server import create_tiles_for_geotiff
+    
+    stats = Counter()
+    with tempfile.TemporaryDirectory() as output_dir:
+        start = time.perf_counter()
+        # The tiler's progress output and warnings would drown out the report
+        with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+            create_tiles_for_geotiff(geotiff_path, output_dir, zoom, zoom, stats=stats, **settings)
+        seconds = time.perf_counter() - start
+    
+    return {
+        'tiles': stats['written'],
+        'blank': stats['blank'],
+        'source_reads': stats['reads'],
+        'culled': stats['culled'],
+        'seconds': seconds,
+        'tiles_per_second': stats['written'] / seconds if seconds > 0 else 0.0,
+        'stages': {stage: stats[f"{stage}_seconds"] for stage in STAGES},
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+def run_benchmark(work_dir, sizes, dtypes, nodata_fractions, zooms, settings, repeat=1):
+    """Generate the synthetic rasters, tile each zoom level and return the result rows.
+    
+    Each zoom is run repeat times, each in a fresh process, and the fastest
+    run is kept.
+    """
+    from layer_stats import load_layer_stats
+    
+    # Spawned (not forked) workers start without this process's memory
+    context = multiprocessing.get_context("spawn")
+    results = []
+    
+    for size in sizes:
+        for dtype in dtypes:
+            for nodata_fraction in nodata_fractions:
+                case = case_name(size, dtype, nodata_fraction)
+                path = Path(work_dir) / f"bench_{size}_{dtype}_{round(nodata_fraction * 100)}.tiff"
+                if not path.exists():
+                    create_synthetic_geotiff(path, size, dtype, nodata_fraction)
+                # Precompute the stretch so it is not timed with the first zoom
+                load_layer_stats(path)
+    
+                for zoom in zooms:
+                    runs = []
+                    for _ in range(repeat):
+                        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                            runs.append(executor.submit(run_zoom, str(path), zoom, settings).result())
+                    best = min(runs, key=lambda run: run['seconds'])
+                    results.append({
+                        'case': case,
+                        'size': size,
+                        'dtype': dtype,
+                        'nodata_fraction': nodata_fraction,
+                        'zoom': zoom,
+                        **best,
+                    })
+                    print(f"  {case:<28} z{zoom:<3} {best['tiles']:>6} tiles "
+                          f"{best['tiles_per_second']:>8.1f} tiles/s  "
+                          f"peak {best['peak_rss_mb']:.0f} MB")
+    
+    return results
+
+def environment_info(settings):
+    """Return the software and hardware the benchmark ran on."""
+    import rasterio
+    from PIL import Image
+    
+    return {
+        'timestamp': time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'rasterio': rasterio.__version__,
+        'gdal': rasterio.__gdal_version__,
+        'pillow': Image.__version__,
+        'cpu_count': os.cpu_count(),
+        'settings': settings,
+    }
+
+def compare_results(results, baseline, threshold=REGRESSION_THRESHOLD):
+    """Print each case's change against a baseline and return the number of regressions.
+    
+    A case regresses when its tiles per second drop, or its peak RSS grows,
+    by more than threshold (a fraction).
+    """
+    baseline_rows = {(row['case'], row['zoom']): row for row in baseline['results']}
+    regressions = 0
+    
+    print(f"\nComparison against baseline from {baseline['environment'].get('timestamp', 'unknown')}:")
+    for row in results:
+        base = baseline_rows.get((row['case'], row['zoom']))
+        if base is None:
+            print(f"  {row['case']:<28} z{row['zoom']:<3} not in baseline")
+            continue
+    
+        speed_change = (row['tiles_per_second'] / base['tiles_per_second'] - 1
+                        if base['tiles_per_second'] else 0.0)
+        rss_change = row['peak_rss_mb'] / base['peak_rss_mb'] - 1 if base['peak_rss_mb'] else 0.0
+        problems = []
+        if speed_change < -threshold:
+            problems.append("slower")
+        if rss_change > threshold:
+            problems.append("more memory")
+    
+        # The stage with the largest absolute slowdown points at the cause
+        stage_changes = {stage: row['stages'][stage] - base['stages'].get(stage, 0.0)
+                         for stage in STAGES}
+        worst_stage = max(stage_changes, key=stage_changes.get)
+    
+        status = f"❌ {', '.join(problems)}" if problems else "✅"
+        print(f"  {row['case']:<28} z{row['zoom']:<3} tiles/s {speed_change:+7.1%}  "
+              f"peak RSS {rss_change:+7.1%}  "
+              f"(largest stage change: {worst_stage} {stage_changes[worst_stage]:+.2f}s)  {status}")
+        regressions += bool(problems)
+    
+    return regressions
+
+def main():
+    """Main function to run the tiling benchmark."""
+    
+    parser = argparse.ArgumentParser(description='Benchmark XYZ tiling on synthetic GeoTIFFs')
+    parser.add_argument('--sizes', default='1024,4096',
+                       help='Comma-separated raster widths/heights in pixels (default: 1024,4096)')
+    parser.add_argument('--dtypes', default='float32,uint16',
+                       help='Comma-separated raster dtypes (default: float32,uint16)')
+    parser.add_argument('--nodata', default='0,0.3',
+                       help='Comma-separated nodata fractions (default: 0,0.3)')
+    parser.add_argument('--zooms', default='11-14',
+                       help='Zoom range to tile, e.g. 11-14 (default: 11-14)')
+    parser.add_argument('--repeat', type=int, default=1,
+                       help='Runs per zoom level; the fastest is kept (default: 1)')
+    parser.add_argument('--workers', type=int, default=1,
+                       help='Tiler worker processes; stage timings are then summed over workers (default: 1)')
+    parser.add_argument('--metatile-size', type=int, default=1,
+                       help='Tiler metatile size (default: 1)')
+    parser.add_argument('--encoding', default='png', choices=['png', 'png8', 'webp', 'webp-lossless'],
+                       help='Tile encoding (default: png)')
+    parser.add_argument('--format', default='xyz', choices=['xyz', 'mbtiles', 'pmtiles'],
+                       help='Tile output format (default: xyz)')
+    parser.add_argument('--work-dir',
+                       help='Keep the synthetic GeoTIFFs in this directory and reuse them across runs')
+    parser.add_argument('--output',
+                       help='Write the results as JSON to this file (default: print them)')
+    parser.add_argument('--baseline',
+                       help='Compare against the JSON results of an earlier run')
+    parser.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD,
+                       help=f'Fractional change flagged as a regression (default: {REGRESSION_THRESHOLD})')
+    
+    args = parser.parse_args()
+    
+    min_zoom, _, max_zoom = args.zooms.partition("-")
+    zooms = list(range(int(min_zoom), int(max_zoom or min_zoom) + 1))
+    settings = {
+        'workers': args.workers,
+        'metatile_size': args.metatile_size,
+        'tile_encoding': args.encoding,
+        'output_format': args.format,
+    }
+    
+    print("XYZ Tiling Benchmark")
+    print("=" * 50)
+    
+    with contextlib.ExitStack() as stack:
+        if args.work_dir:
+            work_dir = Path(args.work_dir)
+            work_dir.mkdir(parents=True, exist_ok=True)
+        else:
+            work_dir = stack.enter_context(tempfile.TemporaryDirectory())
+    
+        results = run_benchmark(
+            work_dir,
+            sizes=[int(size) for size in args.sizes.split(",")],
+            dtypes=args.dtypes.split(","),
+            nodata_fractions=[float(fraction) for fraction in args.nodata.split(",")],
+            zooms=zooms,
+            settings=settings,
+            repeat=args.repeat,
+        )
+    
+    report = {'environment': environment_info(settings), 'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"\n✅ Results written to {args.output}")
+    else:
+        print(json.dumps(report, indent=2))
+    
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare_results(results, baseline, args.threshold)
+        if regressions:
+            print(f"\n❌ {regressions} regression(s) beyond {args.threshold:.0%}")
+            sys.exit(1)
+        print(f"\n✅ No regressions beyond {args.threshold:.0%}")
+
+if __name__ == "__main__":
+    main()
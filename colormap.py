@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""
+Lookup-table colour mapping shared by the tile generator and the PNG overlay generator.
+Each palette is precomputed once as a 256-entry RGBA table, so colouring a
+normalized uint8 array is a single vectorized indexing step.
+"""
+
+from functools import lru_cache
+
+import numpy as np
+
+# Value ranges used to normalize each layer type to 0-255.
+# Layer types without a fixed range are auto-scaled from their data.
+VALUE_RANGES = {
+    "vegetation": (-0.2, 1.0),  # NDVI, EVI, SAVI: typically 0-1, can be negative
+    "moisture": (0.0, 1.0),     # Moisture indices: usually 0-1
+    "soil": (-6.0, 5.0),        # Barren soil index: centred around 0
+}
+
+# Default palette for each layer type
+LAYER_PALETTES = {
+    "vegetation": "vegetation",
+    "moisture": "moisture",
+    "soil": "soil",
+    "default": "grayscale",
+}
+
+# Colour stops (position 0-1, (r, g, b)) for the interpolated named palettes
+PALETTE_STOPS = {
+    "ndvi": [  # Red (bare) through yellow to dark green (dense canopy)
+        (0.0, (165, 0, 38)),
+        (0.25, (244, 109, 67)),
+        (0.5, (255, 255, 191)),
+        (0.75, (102, 189, 99)),
+        (1.0, (0, 104, 55)),
+    ],
+    "evi": [  # Brown (bare) through cream to teal green
+        (0.0, (140, 81, 10)),
+        (0.5, (246, 232, 195)),
+        (1.0, (1, 102, 94)),
+    ],
+}
+
+PALETTES = ["vegetation", "moisture", "soil", "grayscale", *PALETTE_STOPS]
+
+def normalize_values(data, layer_type, value_range=None):
+    """Clip and scale data to uint8 (0-255) for a layer type.
+
+    value_range overrides the layer type's fixed range. Layer types without
+    a fixed range are scaled between the data's 2nd and 98th percentiles.
+    """
+    if value_range is None:
+        value_range = VALUE_RANGES.get(layer_type)
+    if value_range is None:
+        value_range = np.nanpercentile(data, [2, 98])
+
+    min_val, max_val = value_range
+    clipped = np.clip(data, min_val, max_val)
+    if max_val > min_val:
+        return ((clipped - min_val) / (max_val - min_val) * 255).astype(np.uint8)
+    return np.zeros_like(clipped, dtype=np.uint8)
+
+def band_value_range(dtype):
+    """Return the stretch range of one band of a rendered multi-band export.
+
+    Integer bands span their type's full range; float bands span 0-1.
+    """
+    dtype = np.dtype(dtype)
+    if np.issubdtype(dtype, np.integer):
+        return (0, np.iinfo(dtype).max)
+    return (0.0, 1.0)
+
+def stretch_bands(data, value_ranges, out=None):
+    """Linearly stretch (bands, rows, cols) data into an interleaved (rows, cols, bands) uint8 array.
+
+    value_ranges holds one (min, max) pair per band. All bands are scaled
+    in one vectorized pass; NaNs become 0.
+    """
+    ranges = np.asarray(value_ranges, dtype=np.float32)
+    mins = ranges[:, 0, np.newaxis, np.newaxis]
+    scales = 255 / np.maximum(ranges[:, 1] - ranges[:, 0], np.finfo(np.float32).eps)
+
+    scaled = (data - mins) * scales[:, np.newaxis, np.newaxis]
+    np.clip(scaled, 0, 255, out=scaled)
+    np.nan_to_num(scaled, copy=False, nan=0)
+
+    if out is None:
+        out = np.empty(data.shape[1:] + data.shape[:1], dtype=np.uint8)
+    out[...] = np.moveaxis(scaled, 0, -1)
+    return out
+
+def palette_for_layer(layer_type):
+    """Return the default palette name for a layer type."""
+    return LAYER_PALETTES.get(layer_type, "grayscale")
+
+@lru_cache(maxsize=None)
+def get_lut(palette, channels=4):
+    """Return the (256, channels) uint8 lookup table for a named palette."""
+    values = np.arange(256)
+    lut = np.zeros((256, 4), dtype=np.uint8)
+    lut[:, 3] = 255
+
+    if palette == "vegetation":  # Green with some red for variation
+        lut[:, 0] = values // 3
+        lut[:, 1] = values
+    elif palette == "moisture":  # Blue with a slight red tint
+        lut[:, 0] = values // 4
+        lut[:, 2] = values
+    elif palette == "soil":  # Brown/orange
+        lut[:, 0] = values
+        lut[:, 1] = values // 2
+    elif palette == "grayscale":
+        lut[:, :3] = values[:, np.newaxis]
+    elif palette in PALETTE_STOPS:
+        positions = [stop[0] * 255 for stop in PALETTE_STOPS[palette]]
+        for channel in range(3):
+            colours = [stop[1][channel] for stop in PALETTE_STOPS[palette]]
+            lut[:, channel] = np.round(np.interp(values, positions, colours))
+    else:
+        raise ValueError(f"Unknown palette: {palette}")
+
+    lut = np.ascontiguousarray(lut[:, :channels])
+    lut.flags.writeable = False
+    return lut
+
+def apply_colormap(values, palette, channels=3, out=None):
+    """Map a uint8 array through a palette into an (..., channels) uint8 array.
+
+    Pass a preallocated out array to reuse it across calls.
+    """
+    return np.take(get_lut(palette, channels), values, axis=0, out=out)
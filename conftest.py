@@ -0,0 +1,30 @@
+#!/usr/bin/env python3
+"""
+Shared fixtures for the checks in test_*.py.
+"""
+
+import numpy as np
+import pytest
+import rasterio
+from rasterio.transform import from_origin
+
+# 10 m pixels in UTM zone 40S, over the estates
+RASTER_CRS = 'EPSG:32740'
+RASTER_TRANSFORM = from_origin(563000, 7742500, 10, 10)
+
+@pytest.fixture
+def write_raster():
+    """Return a function writing a synthetic tiled GeoTIFF.
+    
+    data is (rows, cols) for a single band or (bands, rows, cols); dtype,
+    nodata and transform default to float32 with NaN as nodata on
+    RASTER_TRANSFORM.
+    """
+    def write(path, data, dtype='float32', nodata=np.nan, transform=RASTER_TRANSFORM):
+        data = np.asarray(data, dtype=dtype)
+        bands = data if data.ndim == 3 else data[np.newaxis]
+        with rasterio.open(path, 'w', driver='GTiff', width=bands.shape[2], height=bands.shape[1],
+                           count=bands.shape[0], dtype=dtype, crs=RASTER_CRS, transform=transform,
+                           nodata=nodata, tiled=True) as dst:
+            dst.write(bands)
+    return write
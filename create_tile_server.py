@@ -5,156 +5,1473 @@ Creates XYZ tile structure that can be served directly or via a simple HTTP serv
 """
 
 import os
+import io
+import gzip
+import json
 import math
+import time
+import hashlib
+import sqlite3
+import struct
+import argparse
+import threading
+import contextlib
 import rasterio
-from rasterio.warp import calculate_default_transform, reproject, Resampling
+from affine import Affine
+from rasterio.coords import BoundingBox
+from rasterio.enums import MaskFlags
+from rasterio.features import rasterize
+from rasterio.vrt import WarpedVRT
+from rasterio.warp import calculate_default_transform, transform_bounds, transform_geom, Resampling
 from rasterio.windows import Window
 from PIL import Image
 import numpy as np
 from pathlib import Path
+from collections import Counter, OrderedDict
+from colormap import (PALETTES, apply_colormap, band_value_range, get_lut, normalize_values,
+                      palette_for_layer, stretch_bands)
+from layer_stats import band_value_ranges, layer_value_range
+from optimize_geotiffs import find_tiff_files, is_up_to_date, optimized_path
+from tile_grid import (children, grid_transform, range_tiles, tile_bounds, tile_range, tile_windows,
+                       tms_row, zxy_to_tile_id)
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 
-def deg2num(lat_deg, lon_deg, zoom):
-    """Convert lat/lon to tile numbers."""
-    lat_rad = math.radians(lat_deg)
-    n = 2.0 ** zoom
-    xtile = int((lon_deg + 180.0) / 360.0 * n)
-    ytile = int((1.0 - math.asinh(math.tan(lat_rad)) / math.pi) / 2.0 * n)
-    return (xtile, ytile)
-
-def num2deg(xtile, ytile, zoom):
-    """Convert tile numbers to lat/lon."""
-    n = 2.0 ** zoom
-    lon_deg = xtile / n * 360.0 - 180.0
-    lat_rad = math.atan(math.sinh(math.pi * (1 - 2 * ytile / n)))
-    lat_deg = math.degrees(lat_rad)
-    return (lat_deg, lon_deg)
-
-def normalize_band_for_display(band_data, band_type="vegetation"):
-    """Normalize band data for display (0-255)."""
-    
-    if band_type == "vegetation":  # NDVI, EVI, SAVI
-        # Vegetation indices typically range 0-1, but can have negative values
-        # Clip to reasonable range and normalize
-        clipped = np.clip(band_data, -0.2, 1.0)
-        normalized = ((clipped + 0.2) / 1.2 * 255).astype(np.uint8)
-    elif band_type == "moisture":  # Moisture indices
-        # Usually 0-1 range
-        clipped = np.clip(band_data, 0, 1)
-        normalized = (clipped * 255).astype(np.uint8)
-    elif band_type == "soil":  # Barren soil index
-        # Can have negative values, normalize around 0
-        clipped = np.clip(band_data, -6, 5)
-        normalized = ((clipped + 6) / 11 * 255).astype(np.uint8)
-    else:  # Default
-        # Auto-scale based on data range
-        min_val, max_val = np.nanpercentile(band_data, [2, 98])  # Use 2-98 percentile
-        clipped = np.clip(band_data, min_val, max_val)
-        if max_val > min_val:
-            normalized = ((clipped - min_val) / (max_val - min_val) * 255).astype(np.uint8)
-        else:
-            normalized = np.zeros_like(clipped, dtype=np.uint8)
-    
-    return normalized
+# Number of distinct tile images whose PNG encoding is reused within a shard
+ENCODE_CACHE_SIZE = 256
 
-def create_tiles_for_geotiff(geotiff_path, output_dir, min_zoom=10, max_zoom=16):
-    """Create XYZ tiles from a GeoTIFF file."""
-    
-    geotiff_path = Path(geotiff_path)
-    layer_name = geotiff_path.stem
-    
-    # Determine band type for proper normalization
+# Largest shard of tiles sent to a worker, and how many shards per worker
+# may be in flight; together they bound the encoded tiles held in the parent
+SHARD_MAX_TILES = 256
+SHARDS_IN_FLIGHT_PER_WORKER = 2
+
+# Source windows this many times larger than a tile are read decimated
+DECIMATED_READ_RATIO = 2
+
+# Blocks are culled from a read of the dataset mask at 1/MASK_CULL_RATIO
+# of their output size before any data is read
+MASK_CULL_RATIO = 8
+
+# Web Mercator (EPSG:3857) grid used by XYZ tiles
+WEB_MERCATOR_CRS = "EPSG:3857"
+
+# PMTiles v3 header layout, tile type codes, and the space the root directory
+# may take so that header and root fit in the archive's first 16 KiB
+PMTILES_HEADER = struct.Struct("<7sB11Q6B4iB2i")
+PMTILES_TILE_TYPES = {"png": 2, "webp": 4}
+PMTILES_ROOT_DIR_BYTES = 16384 - PMTILES_HEADER.size
+
+# Default memory budget for tiles rendered on demand by the dynamic tile server
+DYNAMIC_CACHE_BYTES = 64 * 1024 * 1024
+
+# Approximate memory of one cache entry besides its tile bytes (key tuple and
+# LRU bookkeeping), so that even empty blank tiles count towards the budget
+CACHE_ENTRY_OVERHEAD_BYTES = 256
+
+# Open Web Mercator views kept per layer by the dynamic tile server, shared by
+# its connection threads; more are opened while more tiles render at once
+VIEW_POOL_SIZE = 8
+
+def normalize_band_for_display(band_data, band_type="vegetation", value_range=None):
+    """Normalize band data for display (0-255), optionally with a precomputed layer stretch."""
+    return normalize_values(band_data, band_type, value_range)
+
+def get_band_type(layer_name):
+    """Determine band type for proper normalization from the layer name."""
     if "NDVI" in layer_name or "EVI" in layer_name or "SAVI" in layer_name or "Agriculture" in layer_name:
-        band_type = "vegetation"
+        return "vegetation"
     elif "Moisture" in layer_name:
-        band_type = "moisture"
+        return "moisture"
     elif "Soil" in layer_name:
-        band_type = "soil"
+        return "soil"
+    return "default"
+
+# Layers exported as rendered multi-band composites rather than single index bands
+COMPOSITE_LAYER_KEYWORDS = ("Agriculture", "True_color", "False_color")
+
+def get_composite_bands(layer_name, band_count):
+    """Return the (red, green, blue) band indexes of a composite layer, or None for single-band layers."""
+    if band_count >= 3 and any(keyword in layer_name for keyword in COMPOSITE_LAYER_KEYWORDS):
+        return (1, 2, 3)
+    return None
+
+def check_bands(bands):
+    """Raise ValueError unless bands is three 1-based (red, green, blue) band indexes."""
+    if len(bands) != 3 or min(bands) < 1:
+        raise ValueError(f"Expected three 1-based band indexes for red, green and blue, got {bands}")
+
+def select_bands(layer_name, band_count, bands=None):
+    """Return the (red, green, blue) bands to render a layer from, or None to render band 1.
+    
+    Requested bands are ignored for single-band layers, so one --bands
+    value can be used for a mix of composite and index layers. Without
+    bands, composite layers use get_composite_bands. Raises ValueError for
+    bands that are not three indexes between 1 and band_count.
+    """
+    if bands is None or band_count == 1:
+        return get_composite_bands(layer_name, band_count)
+    check_bands(bands)
+    if max(bands) > band_count:
+        raise ValueError(f"{layer_name} has {band_count} bands, cannot render bands {bands}")
+    return tuple(bands)
+
+def parse_bands(value):
+    """Parse a --bands value such as "4,3,2" into three band indexes."""
+    try:
+        bands = tuple(int(band) for band in value.split(','))
+        check_bands(bands)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(f"invalid bands {value!r}: {e}")
+    return bands
+
+def ensure_overviews(geotiff_path, resampling=Resampling.average):
+    """Build internal overviews for a GeoTIFF that has none. Returns the factors built."""
+    with rasterio.open(geotiff_path) as src:
+        if src.overviews(1):
+            return []
+        
+        # Halve until the smallest overview fits within a single tile
+        factors = []
+        factor = 2
+        while max(src.width, src.height) / (factor // 2) > 256:
+            factors.append(factor)
+            factor *= 2
+    
+    if factors:
+        with rasterio.open(geotiff_path, 'r+') as dst:
+            dst.build_overviews(factors, resampling)
+            dst.update_tags(ns='rio_overview', resampling=resampling.name)
+    
+    return factors
+
+def open_web_mercator_view(src, resampling=Resampling.bilinear):
+    """Open a reusable EPSG:3857 warped view of a dataset.
+    
+    The source is warped onto one Mercator grid up front, so every tile is
+    a plain windowed read on that grid instead of its own reprojection.
+    Internal masks are carried through the warp as an alpha band. Rasters
+    without nodata get NaN as the view's nodata (floats) or an alpha band
+    (integers), so the area outside the source footprint is masked instead
+    of reading 0.
+    """
+    transform, width, height = calculate_default_transform(
+        src.crs, WEB_MERCATOR_CRS, src.width, src.height, *src.bounds
+    )
+    options = {}
+    flags = src.mask_flag_enums[0]
+    is_float = np.issubdtype(np.dtype(src.dtypes[0]), np.floating)
+    if MaskFlags.alpha in flags:
+        pass  # The source alpha band is warped along with the data
+    elif MaskFlags.per_dataset in flags or (src.nodata is None and not is_float):
+        options['add_alpha'] = True
+    elif src.nodata is None:
+        options['nodata'] = np.nan
+    return WarpedVRT(src, crs=WEB_MERCATOR_CRS, transform=transform,
+                     width=width, height=height, resampling=resampling, **options)
+
+def get_geographic_bounds(dataset):
+    """Return the dataset bounds in WGS84 longitude/latitude."""
+    return BoundingBox(*transform_bounds(dataset.crs, "EPSG:4326", *dataset.bounds))
+
+def load_field_geometries(geojson_path):
+    """Load polygon geometries from a GeoJSON file, reprojected to Web Mercator."""
+    with open(geojson_path) as f:
+        geojson = json.load(f)
+    
+    return [
+        transform_geom("EPSG:4326", WEB_MERCATOR_CRS, feature['geometry'])
+        for feature in geojson['features']
+        if feature.get('geometry')
+    ]
+
+def field_tile_mask(geometries, zoom, min_tile_x, max_tile_x, min_tile_y, max_tile_y, buffer_tiles=0):
+    """Return a (rows, cols) boolean mask of the tiles in the range touched by any geometry.
+    
+    The geometries are rasterized onto a grid whose pixels are the tiles of
+    this zoom level, so every field is matched against all tiles in one
+    pass. buffer_tiles grows the mask by that many tiles in every direction.
+    """
+    transform = Affine(*grid_transform(zoom, min_tile_x, min_tile_y))
+    shape = (max_tile_y - min_tile_y + 1, max_tile_x - min_tile_x + 1)
+    
+    mask = rasterize(((geometry, 1) for geometry in geometries), out_shape=shape,
+                     transform=transform, fill=0, all_touched=True, dtype='uint8').astype(bool)
+    
+    if buffer_tiles > 0:
+        padded = np.pad(mask, buffer_tiles)
+        buffered = np.zeros_like(mask)
+        for dy in range(2 * buffer_tiles + 1):
+            for dx in range(2 * buffer_tiles + 1):
+                buffered |= padded[dy:dy + shape[0], dx:dx + shape[1]]
+        mask = buffered
+    
+    return mask
+
+def has_mask_band(src, band=1):
+    """Check whether a band's validity comes from an internal mask or alpha band rather than nodata."""
+    flags = src.mask_flag_enums[band - 1]
+    return MaskFlags.per_dataset in flags or MaskFlags.alpha in flags
+
+def valid_data_mask(src, data):
+    """Return a boolean mask of pixels that are neither NaN nor the dataset nodata value."""
+    if np.issubdtype(data.dtype, np.floating):
+        valid = ~np.isnan(data)
     else:
-        band_type = "default"
+        valid = np.ones(data.shape, dtype=bool)
+    if src.nodata is not None and not np.isnan(src.nodata):
+        valid &= data != src.nodata
+    return valid
+
+def metatile_windows(src, zoom, tiles, size=1):
+    """Return the pixel Window of src under each size x size block of tiles.
     
-    print(f"Processing {layer_name} (type: {band_type})...")
+    tiles are the (x, y) numbers of the blocks' top-left tiles. The windows
+    of a whole zoom level are computed in one vectorized pass.
+    """
+    tiles = np.asarray(tiles, dtype=np.int64).reshape(-1, 2)
+    windows = np.column_stack(np.broadcast_arrays(*tile_windows(tiles[:, 0], tiles[:, 1], zoom,
+                                                                 src.transform, size)))
+    return [Window(*window) for window in windows.tolist()]
+
+def read_tile_block(src, window, band_type, size=1, stats=None, bands=None, value_range=None):
+    """Read and normalize a size x size block of tiles covering a window of src.
     
-    with rasterio.open(geotiff_path) as src:
-        bounds = src.bounds
+    window is the block's pixel window (see metatile_windows). Returns
+    (tile_data, valid): a (size * 256) square uint8 array and the matching
+    boolean mask of pixels backed by valid data, or None if the block has
+    nothing to draw. src must be a Web Mercator view of the raster
+    (see open_web_mercator_view). Reads are counted in stats['reads'], and
+    the time spent reading, normalizing and resizing in
+    stats['read_seconds'], ['normalize_seconds'] and ['resize_seconds'].
+    
+    Before the data is read, the dataset mask (internal mask, alpha or
+    nodata) is read at 1/MASK_CULL_RATIO of the block's size. Blocks with no
+    valid pixels are dropped there and counted in stats['culled']. The mask
+    also marks the valid pixels of the blocks that are read.
+    
+    value_range is the layer's (min, max) stretch (see
+    layer_stats.layer_value_range). Without it, layers with no fixed range
+    are stretched from the block's own percentiles.
+    
+    With bands, those band indexes are read together and stretched into an
+    RGB tile_data of shape (size * 256, size * 256, 3) instead, and
+    value_range holds one (min, max) stretch per band (see
+    layer_stats.band_value_ranges); without it, bands span their dtype's range.
+    """
+    block_px = size * 256
+    
+    # Clip the block's window to the raster. Edge tiles only cover part of
+    # the raster, so work out where that part lands in the block.
+    try:
+        clipped = window.intersection(Window(0, 0, src.width, src.height))
+    except rasterio.errors.WindowError:
+        return None
+    
+    x0 = round((clipped.col_off - window.col_off) / window.width * block_px)
+    x1 = round((clipped.col_off + clipped.width - window.col_off) / window.width * block_px)
+    y0 = round((clipped.row_off - window.row_off) / window.height * block_px)
+    y1 = round((clipped.row_off + clipped.height - window.row_off) / window.height * block_px)
+    if x1 <= x0 or y1 <= y0:
+        return None
+    
+    # A small decimated mask read, served from overviews where the dataset
+    # has them, rules out empty blocks (ocean, outside the scene) cheaply
+    start = time.perf_counter()
+    mask_band = bands[0] if bands else 1
+    cull_shape = (max(1, (y1 - y0) // MASK_CULL_RATIO), max(1, (x1 - x0) // MASK_CULL_RATIO))
+    coverage = src.read_masks(mask_band, window=clipped, out_shape=cull_shape,
+                              resampling=Resampling.average)
+    if not coverage.any():
+        if stats is not None:
+            stats['culled'] += 1
+            stats['read_seconds'] += time.perf_counter() - start
+        return None
+    
+    # Large windows are read straight at tile size so GDAL can serve them
+    # from the dataset's overviews.
+    if stats is not None:
+        stats['reads'] += 1
+    decimated = (clipped.width > (x1 - x0) * DECIMATED_READ_RATIO or
+                 clipped.height > (y1 - y0) * DECIMATED_READ_RATIO)
+    if bands:
+        # All bands in one read, into a preallocated (bands, rows, cols) array
+        if decimated:
+            shape = (y1 - y0, x1 - x0)
+        else:
+            shape = (round(clipped.height), round(clipped.width))
+        data = np.empty((len(bands),) + shape, dtype=src.dtypes[bands[0] - 1])
+        src.read(indexes=list(bands), window=clipped, out=data, resampling=Resampling.average)
+        valid = valid_data_mask(src, data).all(axis=0)
+    else:
+        # Read the first band (main data)
+        if decimated:
+            data = src.read(1, window=clipped, out_shape=(y1 - y0, x1 - x0),
+                            resampling=Resampling.average)
+        else:
+            data = src.read(1, window=clipped)
+        valid = valid_data_mask(src, data)
+    
+    # Internal masks and alpha bands are not visible in the data itself
+    if has_mask_band(src, mask_band):
+        valid &= src.read_masks(mask_band, window=clipped, out_shape=valid.shape) > 0
+    if stats is not None:
+        stats['read_seconds'] += time.perf_counter() - start
+    
+    # Fully masked blocks are skipped before any normalization or encoding
+    if data.size == 0 or not valid.any():
+        return None
+    
+    start = time.perf_counter()
+    if bands:
+        img_data = stretch_bands(data, value_range or [band_value_range(data.dtype)] * len(bands))
+    else:
+        img_data = normalize_band_for_display(data, band_type, value_range)
+    if stats is not None:
+        stats['normalize_seconds'] += time.perf_counter() - start
+    
+    # Resize to the covered part of the block
+    if img_data.shape[:2] != (y1 - y0, x1 - x0):
+        # Use PIL for resizing
+        start = time.perf_counter()
+        img = Image.fromarray(img_data, mode='RGB' if bands else 'L')
+        img = img.resize((x1 - x0, y1 - y0), Image.Resampling.LANCZOS)
+        img_data = np.array(img)
+        valid = np.array(Image.fromarray(valid).resize((x1 - x0, y1 - y0), Image.Resampling.NEAREST))
+        if stats is not None:
+            stats['resize_seconds'] += time.perf_counter() - start
+    
+    if img_data.shape[:2] == (block_px, block_px):
+        return img_data, valid
+    
+    tile_data = np.zeros((block_px, block_px) + img_data.shape[2:], dtype=np.uint8)
+    tile_data[y0:y1, x0:x1] = img_data
+    valid_block = np.zeros((block_px, block_px), dtype=bool)
+    valid_block[y0:y1, x0:x1] = valid
+    return tile_data, valid_block
+
+def colorize_tile(tile_data, band_type, palette=None, out=None):
+    """Turn a normalized uint8 tile into an RGB array through the layer's colour lookup table.
+    
+    palette overrides the band type's default palette; out is an optional
+    reusable (256, 256, 3) uint8 buffer.
+    """
+    return apply_colormap(tile_data, palette or palette_for_layer(band_type), 3, out)
+
+def with_alpha(tile_data, valid):
+    """Return an RGB tile unchanged if every pixel is valid, else as RGBA with invalid pixels transparent."""
+    if valid.all():
+        return tile_data
+    return np.dstack((tile_data, valid.astype(np.uint8) * 255))
+
+class TileEncoder:
+    """Encodes tiles as RGB PNG, 8-bit palette PNG (png8) or lossy/lossless WebP.
+    
+    level is the PNG compress_level (0-9) or the WebP quality (0-100);
+    None keeps the encoder default.
+    """
+    
+    FORMATS = ("png", "png8", "webp", "webp-lossless")
+    
+    def __init__(self, tile_format="png", level=None):
+        if tile_format not in self.FORMATS:
+            raise ValueError(f"Unknown tile encoding: {tile_format}")
+        self.tile_format = tile_format
+        self.level = level
+    
+    @property
+    def extension(self):
+        return "webp" if self.tile_format.startswith("webp") else "png"
+    
+    def _save(self, img):
+        buffer = io.BytesIO()
+        if self.extension == "png":
+            img.save(buffer, 'PNG', compress_level=6 if self.level is None else self.level)
+        else:
+            img.save(buffer, 'WEBP', lossless=self.tile_format == "webp-lossless",
+                     quality=80 if self.level is None else self.level)
+        return buffer.getvalue()
+    
+    def encode(self, rgb_data, palette=None):
+        """Encode an RGB or RGBA tile array.
+        
+        png8 quantizes RGB tiles to the palette's colours, and RGBA tiles
+        (or any tile without a palette) to their own 256 colours.
+        """
+        img = Image.fromarray(rgb_data, mode='RGBA' if rgb_data.shape[2] == 4 else 'RGB')
+        if self.tile_format == "png8":
+            if palette is None or img.mode == 'RGBA':
+                img = img.quantize(256)
+            else:
+                palette_img = Image.new('P', (1, 1))
+                palette_img.putpalette(get_lut(palette, 3).tobytes())
+                img = img.quantize(palette=palette_img, dither=Image.Dither.NONE)
+        return self._save(img)
+    
+    def encode_indexed(self, tile_data, palette):
+        """Encode a normalized uint8 tile as a png8 whose palette is the lookup table.
         
-        # Create output directory structure
-        layer_dir = Path(output_dir) / layer_name
-        layer_dir.mkdir(parents=True, exist_ok=True)
+        The normalized values are the palette indices, so no colour mapping
+        or quantization is needed.
+        """
+        img = Image.fromarray(tile_data)
+        img.putpalette(get_lut(palette, 3).tobytes())
+        return self._save(img)
+
+def encode_tile_cached(tile_array, encode_cache, encode, stats=None):
+    """Encode a tile with encode(tile_array), reusing the bytes of an identical tile encoded earlier.
+    
+    Flat single-colour tiles (sea, masked land) repeat often, so their
+    encoding is looked up by a hash of the raw pixels instead of redone.
+    Real encodes are counted in stats['encoded'], ['encoded_bytes'] and
+    ['encode_seconds'].
+    """
+    key = hashlib.blake2b(tile_array.tobytes(), digest_size=16).digest()
+    tile_bytes = encode_cache.get(key)
+    if tile_bytes is None:
+        start = time.perf_counter()
+        tile_bytes = encode(tile_array)
+        if stats is not None:
+            stats['encode_seconds'] += time.perf_counter() - start
+            stats['encoded'] += 1
+            stats['encoded_bytes'] += len(tile_bytes)
+        if len(encode_cache) < ENCODE_CACHE_SIZE:
+            encode_cache[key] = tile_bytes
+    return tile_bytes
+
+def tile_digest(tile_bytes):
+    """Content hash used to deduplicate identical tile payloads."""
+    return hashlib.sha1(tile_bytes).hexdigest()
+
+def decode_tile(tile_bytes):
+    """Decode PNG or WebP tile bytes into an RGB array, or RGBA if the tile has transparency."""
+    with Image.open(io.BytesIO(tile_bytes)) as img:
+        return np.array(img.convert('RGBA' if img.has_transparency_data else 'RGB'))
+
+class DirectoryTileStore:
+    """Tile output as a layer/z/x/y.png (or .webp) directory tree.
+    
+    Identical tiles are written once and hard-linked from every other
+    position they appear at.
+    """
+    
+    def __init__(self, layer_dir, extension="png"):
+        self.path = Path(layer_dir)
+        self.extension = extension
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.deduplicated = 0
+        self._first_paths = {}
+    
+    def __getstate__(self):
+        # Workers only read tiles, they never need the dedup index
+        state = self.__dict__.copy()
+        state['_first_paths'] = {}
+        return state
+    
+    def prepare_zoom(self, zoom, min_tile_x, max_tile_x):
+        """Create the z/x directories for a zoom level."""
+        zoom_dir = self.path / str(zoom)
+        zoom_dir.mkdir(exist_ok=True)
+        for tile_x in range(min_tile_x, max_tile_x + 1):
+            (zoom_dir / str(tile_x)).mkdir(exist_ok=True)
+    
+    def write_tile(self, zoom, tile_x, tile_y, tile_bytes):
+        tile_path = self.path / str(zoom) / str(tile_x) / f"{tile_y}.{self.extension}"
         
-        for zoom in range(min_zoom, max_zoom + 1):
-            print(f"  Creating zoom level {zoom}...")
+        # Never write through an existing path, it may be a link to a shared tile
+        tile_path.unlink(missing_ok=True)
+        
+        digest = tile_digest(tile_bytes)
+        first_path = self._first_paths.get(digest)
+        if first_path is not None:
+            try:
+                os.link(first_path, tile_path)
+                self.deduplicated += 1
+                return
+            except OSError:
+                pass
+        
+        tile_path.write_bytes(tile_bytes)
+        self._first_paths.setdefault(digest, tile_path)
+    
+    def read_tile(self, zoom, tile_x, tile_y):
+        """Return the tile bytes, or None if the tile does not exist."""
+        tile_path = self.path / str(zoom) / str(tile_x) / f"{tile_y}.{self.extension}"
+        if not tile_path.exists():
+            return None
+        return tile_path.read_bytes()
+    
+    def flush(self):
+        pass
+    
+    def write_metadata(self, metadata):
+        pass
+    
+    def close(self):
+        pass
+
+class MBTilesTileStore:
+    """Tile output as a single MBTiles (SQLite) file per layer.
+    
+    Uses the deduplicating MBTiles layout: a map table pointing at shared
+    images blobs, exposed through the standard tiles view. Tiles are
+    inserted in batched transactions. MBTiles stores rows in TMS order, so
+    tile y is flipped on the way in and out.
+    """
+    
+    def __init__(self, mbtiles_path, batch_size=500):
+        self.path = Path(mbtiles_path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.batch_size = batch_size
+        self.deduplicated = 0
+        self._pending_map = []
+        self._pending_images = []
+        self._tile_ids = set()
+        self._conn = None
+        
+        with self.connection as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS metadata (name TEXT, value TEXT)")
+            conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS metadata_name ON metadata (name)")
+            conn.execute("CREATE TABLE IF NOT EXISTS map "
+                         "(zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_id TEXT)")
+            conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS map_index "
+                         "ON map (zoom_level, tile_column, tile_row)")
+            conn.execute("CREATE TABLE IF NOT EXISTS images (tile_data BLOB, tile_id TEXT)")
+            conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS images_id ON images (tile_id)")
+            conn.execute("CREATE VIEW IF NOT EXISTS tiles AS "
+                         "SELECT map.zoom_level AS zoom_level, map.tile_column AS tile_column, "
+                         "map.tile_row AS tile_row, images.tile_data AS tile_data "
+                         "FROM map JOIN images ON images.tile_id = map.tile_id")
+    
+    def __getstate__(self):
+        # Worker processes reopen their own connection when they read tiles
+        state = self.__dict__.copy()
+        state['_conn'] = None
+        state['_pending_map'] = []
+        state['_pending_images'] = []
+        state['_tile_ids'] = set()
+        return state
+    
+    @property
+    def connection(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path)
+        return self._conn
+    
+    def prepare_zoom(self, zoom, min_tile_x, max_tile_x):
+        pass
+    
+    def write_tile(self, zoom, tile_x, tile_y, tile_bytes):
+        tile_row = tms_row(zoom, tile_y)
+        tile_id = tile_digest(tile_bytes)
+        if tile_id in self._tile_ids:
+            self.deduplicated += 1
+        else:
+            self._tile_ids.add(tile_id)
+            self._pending_images.append((sqlite3.Binary(tile_bytes), tile_id))
+        self._pending_map.append((zoom, tile_x, tile_row, tile_id))
+        if len(self._pending_map) >= self.batch_size:
+            self.flush()
+    
+    def read_tile(self, zoom, tile_x, tile_y):
+        """Return the tile bytes, or None if the tile does not exist."""
+        tile_row = tms_row(zoom, tile_y)
+        row = self.connection.execute(
+            "SELECT tile_data FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+            (zoom, tile_x, tile_row)
+        ).fetchone()
+        return bytes(row[0]) if row else None
+    
+    def flush(self):
+        """Insert pending tiles in a single transaction."""
+        if not self._pending_map:
+            return
+        with self.connection as conn:
+            conn.executemany("INSERT OR IGNORE INTO images VALUES (?, ?)", self._pending_images)
+            conn.executemany("INSERT OR REPLACE INTO map VALUES (?, ?, ?, ?)", self._pending_map)
+        self._pending_map = []
+        self._pending_images = []
+    
+    def write_metadata(self, metadata):
+        with self.connection as conn:
+            conn.executemany("INSERT OR REPLACE INTO metadata VALUES (?, ?)",
+                             [(name, str(value)) for name, value in metadata.items()])
+    
+    def close(self):
+        self.flush()
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+def _write_varint(buffer, value):
+    while value >= 0x80:
+        buffer.append((value & 0x7F) | 0x80)
+        value >>= 7
+    buffer.append(value)
+
+def serialize_pmtiles_directory(entries):
+    """Encode [tile_id, offset, length, run_length] entries as a gzipped PMTiles directory.
+    
+    Tile ids are delta-encoded and an offset that directly follows the
+    previous entry's data is stored as 0.
+    """
+    buffer = bytearray()
+    _write_varint(buffer, len(entries))
+    last_tile_id = 0
+    for tile_id, _, _, _ in entries:
+        _write_varint(buffer, tile_id - last_tile_id)
+        last_tile_id = tile_id
+    for _, _, _, run_length in entries:
+        _write_varint(buffer, run_length)
+    for _, _, length, _ in entries:
+        _write_varint(buffer, length)
+    for index, (_, offset, _, _) in enumerate(entries):
+        previous = entries[index - 1] if index > 0 else None
+        if previous is not None and offset == previous[1] + previous[2]:
+            _write_varint(buffer, 0)
+        else:
+            _write_varint(buffer, offset + 1)
+    return gzip.compress(bytes(buffer), mtime=0)
+
+def build_pmtiles_directories(entries):
+    """Return (root_directory, leaf_directories) bytes for sorted directory entries.
+    
+    Entries go straight into the root directory when it fits in
+    PMTILES_ROOT_DIR_BYTES; otherwise they are split into leaf directories
+    that the root points at (entries with run_length 0).
+    """
+    root = serialize_pmtiles_directory(entries)
+    if len(root) <= PMTILES_ROOT_DIR_BYTES:
+        return root, b""
+    
+    leaf_size = 4096
+    while True:
+        leaves = bytearray()
+        root_entries = []
+        for start in range(0, len(entries), leaf_size):
+            leaf_entries = entries[start:start + leaf_size]
+            leaf = serialize_pmtiles_directory(leaf_entries)
+            root_entries.append([leaf_entries[0][0], len(leaves), len(leaf), 0])
+            leaves += leaf
+        root = serialize_pmtiles_directory(root_entries)
+        if len(root) <= PMTILES_ROOT_DIR_BYTES:
+            return root, bytes(leaves)
+        leaf_size *= 2
+
+# Per-process cache of the last PMTiles index snapshot loaded by a worker:
+# (index_path, version, tile_ids, payloads)
+_pmtiles_index = None
+
+def _load_pmtiles_index(index_path, version):
+    """Return the sorted (tile_ids, payloads) arrays of a PMTiles index snapshot, loading each version once."""
+    global _pmtiles_index
+    if _pmtiles_index is None or _pmtiles_index[:2] != (index_path, version):
+        index = np.load(index_path)
+        _pmtiles_index = (index_path, version, index[:, 0], index[:, 1:])
+    return _pmtiles_index[2:]
+
+class PMTilesTileStore:
+    """Tile output as a single PMTiles (v3) archive per layer.
+    
+    Tile payloads are appended to a temporary data file as they arrive,
+    each distinct payload once. close() writes the archive: header, gzipped
+    root directory and metadata, leaf directories, and the tile data
+    clustered in tile id order. Runs of consecutive identical tiles share
+    one directory entry.
+    
+    Worker processes read tiles through a snapshot of the tile index that
+    flush() saves next to the data file, so pickling the store sends only
+    the snapshot's path rather than every entry written so far.
+    """
+    
+    def __init__(self, pmtiles_path):
+        self.path = Path(pmtiles_path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.data_path = self.path.with_name(self.path.name + ".data")
+        self.index_path = self.path.with_name(self.path.name + ".index.npy")
+        self.metadata = {}
+        self.deduplicated = 0
+        self._entries = {}
+        self._payloads = {}
+        self._data_size = 0
+        self._data_file = open(self.data_path, "wb")
+        self._reader = None
+        self._index_version = 0
+    
+    def __getstate__(self):
+        # Workers only read tiles, through the flushed index snapshot and the data file
+        state = self.__dict__.copy()
+        state['_entries'] = None
+        state['_payloads'] = {}
+        state['_data_file'] = None
+        state['_reader'] = None
+        return state
+    
+    def prepare_zoom(self, zoom, min_tile_x, max_tile_x):
+        pass
+    
+    def write_tile(self, zoom, tile_x, tile_y, tile_bytes):
+        digest = tile_digest(tile_bytes)
+        payload = self._payloads.get(digest)
+        if payload is None:
+            payload = self._payloads[digest] = (self._data_size, len(tile_bytes))
+            self._data_file.write(tile_bytes)
+            self._data_size += len(tile_bytes)
+        else:
+            self.deduplicated += 1
+        self._entries[zxy_to_tile_id(zoom, tile_x, tile_y)] = payload
+    
+    def read_tile(self, zoom, tile_x, tile_y):
+        """Return the tile bytes, or None if the tile does not exist."""
+        tile_id = zxy_to_tile_id(zoom, tile_x, tile_y)
+        if self._entries is not None:
+            payload = self._entries.get(tile_id)
+        else:
+            # A worker's copy: look the tile up in the last flushed snapshot
+            tile_ids, payloads = _load_pmtiles_index(self.index_path, self._index_version)
+            index = np.searchsorted(tile_ids, tile_id)
+            found = index < len(tile_ids) and tile_ids[index] == tile_id
+            payload = tuple(payloads[index].tolist()) if found else None
+        if payload is None:
+            return None
+        if self._reader is None:
+            self._reader = open(self.data_path, "rb")
+        offset, length = payload
+        return os.pread(self._reader.fileno(), length, offset)
+    
+    def flush(self):
+        """Flush the data file and save the tile index snapshot that workers read from."""
+        if self._data_file is None:
+            return
+        self._data_file.flush()
+        
+        index = np.empty((len(self._entries), 3), dtype=np.uint64)
+        if self._entries:
+            index[:, 0] = np.fromiter(self._entries, dtype=np.uint64, count=len(self._entries))
+            index[:, 1:] = list(self._entries.values())
+            index = index[np.argsort(index[:, 0])]
+        with open(self.index_path, "wb") as f:
+            np.save(f, index)
+        self._index_version += 1
+    
+    def write_metadata(self, metadata):
+        self.metadata.update(metadata)
+    
+    def close(self):
+        """Write the clustered archive and remove the temporary data file."""
+        if self._data_file is None:
+            return
+        self._data_file.close()
+        self._data_file = None
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
+        
+        # Lay the payloads out in tile id order, each distinct payload once
+        entries = []
+        archive_offsets = {}
+        payload_order = []
+        data_length = 0
+        for tile_id in sorted(self._entries):
+            payload = self._entries[tile_id]
+            if payload not in archive_offsets:
+                archive_offsets[payload] = data_length
+                payload_order.append(payload)
+                data_length += payload[1]
+            offset = archive_offsets[payload]
+            last = entries[-1] if entries else None
+            if last is not None and last[0] + last[3] == tile_id and last[1] == offset:
+                last[3] += 1
+            else:
+                entries.append([tile_id, offset, payload[1], 1])
+        
+        root_dir, leaf_dirs = build_pmtiles_directories(entries)
+        metadata = gzip.compress(json.dumps(self.metadata).encode('utf-8'), mtime=0)
+        
+        west, south, east, north = (float(value) for value in
+                                    str(self.metadata.get('bounds', '-180,-85,180,85')).split(","))
+        min_zoom = int(self.metadata.get('minzoom', 0))
+        max_zoom = int(self.metadata.get('maxzoom', min_zoom))
+        metadata_offset = PMTILES_HEADER.size + len(root_dir)
+        leaf_offset = metadata_offset + len(metadata)
+        data_offset = leaf_offset + len(leaf_dirs)
+        header = PMTILES_HEADER.pack(
+            b"PMTiles", 3,
+            PMTILES_HEADER.size, len(root_dir), metadata_offset, len(metadata),
+            leaf_offset, len(leaf_dirs), data_offset, data_length,
+            len(self._entries), len(entries), len(payload_order),
+            # Clustered, gzipped directories, uncompressed tiles
+            1, 2, 1, PMTILES_TILE_TYPES.get(self.metadata.get('format'), 0),
+            min_zoom, max_zoom,
+            round(west * 1e7), round(south * 1e7), round(east * 1e7), round(north * 1e7),
+            min_zoom, round((west + east) / 2 * 1e7), round((south + north) / 2 * 1e7)
+        )
+        
+        with open(self.path, "wb") as archive, open(self.data_path, "rb") as data:
+            archive.write(header)
+            archive.write(root_dir)
+            archive.write(metadata)
+            archive.write(leaf_dirs)
+            for offset, length in payload_order:
+                archive.write(os.pread(data.fileno(), length, offset))
+        self.data_path.unlink()
+        self.index_path.unlink(missing_ok=True)
+
+def open_tile_store(output_dir, layer_name, output_format="xyz", extension="png"):
+    """Open the tile store for a layer in the requested output format."""
+    if output_format == "xyz":
+        return DirectoryTileStore(Path(output_dir) / layer_name, extension)
+    elif output_format == "mbtiles":
+        return MBTilesTileStore(Path(output_dir) / f"{layer_name}.mbtiles")
+    elif output_format == "pmtiles":
+        return PMTilesTileStore(Path(output_dir) / f"{layer_name}.pmtiles")
+    raise ValueError(f"Unknown tile output format: {output_format}")
+
+def render_tiles(src, zoom, tiles, band_type, write_tile, stats, metatile_size=1, palette=None,
+                 encoder=None, bands=None, value_range=None):
+    """Render a list of (x, y) tiles, passing each encoded tile to write_tile.
+    
+    Tiles are read and normalized in metatiles of metatile_size x
+    metatile_size tiles, one source read per metatile, and then sliced into
+    256x256 tiles for encoding with encoder (RGB PNG by default). Blank tiles
+    are counted in stats['blank'] and source reads in stats['reads']. Returns
+    error messages for failed tiles.
+    
+    value_range is the layer's precomputed stretch, so every tile and zoom
+    level is normalized alike.
+    
+    With bands, tiles are rendered in true colour from those band indexes
+    (see read_tile_block) instead of through the palette, and value_range
+    holds one stretch per band.
+    """
+    errors = []
+    encode_cache = {}
+    rgb_buffer = np.empty((256, 256, 3), dtype=np.uint8)
+    encoder = encoder or TileEncoder()
+    palette = palette or palette_for_layer(band_type)
+    
+    # Group the requested tiles by metatile, keeping their order
+    metatiles = {}
+    for tile_x, tile_y in tiles:
+        meta_key = (tile_x // metatile_size, tile_y // metatile_size)
+        metatiles.setdefault(meta_key, []).append((tile_x, tile_y))
+    
+    windows = metatile_windows(src, zoom, [(meta_x * metatile_size, meta_y * metatile_size)
+                                        for meta_x, meta_y in metatiles], metatile_size)
+    
+    for ((meta_x, meta_y), meta_tiles), window in zip(metatiles.items(), windows):
+        try:
+            block = read_tile_block(src, window, band_type, metatile_size, stats, bands, value_range)
+        except Exception as e:
+            errors.extend(f"{zoom}/{tile_x}/{tile_y}: {e}" for tile_x, tile_y in meta_tiles)
+            continue
+        
+        for tile_x, tile_y in meta_tiles:
+            try:
+                row = (tile_y - meta_y * metatile_size) * 256
+                col = (tile_x - meta_x * metatile_size) * 256
+                if block is None or not block[1][row:row + 256, col:col + 256].any():
+                    stats['blank'] += 1
+                    continue
+                
+                tile_data = block[0][row:row + 256, col:col + 256]
+                tile_valid = block[1][row:row + 256, col:col + 256]
+                if bands:
+                    rgb_data = with_alpha(tile_data, tile_valid)
+                    tile_bytes = encode_tile_cached(rgb_data, encode_cache, encoder.encode, stats)
+                elif not tile_valid.all():
+                    # Pixels without data are transparent
+                    rgb_data = with_alpha(colorize_tile(tile_data, band_type, palette), tile_valid)
+                    tile_bytes = encode_tile_cached(rgb_data, encode_cache, encoder.encode, stats)
+                elif encoder.tile_format == "png8":
+                    # Palette PNGs store the normalized values directly as indices
+                    tile_bytes = encode_tile_cached(
+                        tile_data, encode_cache,
+                        lambda indices: encoder.encode_indexed(indices, palette), stats
+                    )
+                else:
+                    rgb_data = colorize_tile(tile_data, band_type, palette, out=rgb_buffer)
+                    tile_bytes = encode_tile_cached(rgb_data, encode_cache, encoder.encode, stats)
+                write_tile(zoom, tile_x, tile_y, tile_bytes)
+                
+            except Exception as e:
+                errors.append(f"{zoom}/{tile_x}/{tile_y}: {e}")
+                continue
+    
+    return errors
+
+def build_parent_tile(store, zoom, tile_x, tile_y):
+    """Build a tile by downsampling its four children at zoom + 1, or None if none exist.
+    
+    The parent is RGBA if any child is missing or has transparency, with
+    missing children left transparent; otherwise it is RGB.
+    """
+    child_tiles = {}
+    child_xs, child_ys = children(tile_x, tile_y)
+    for child_x, child_y in zip(child_xs.tolist(), child_ys.tolist()):
+        child_bytes = store.read_tile(zoom + 1, child_x, child_y)
+        if child_bytes is not None:
+            child_tiles[(child_x - 2 * tile_x, child_y - 2 * tile_y)] = decode_tile(child_bytes)
+    
+    if not child_tiles:
+        return None
+    
+    # Missing children (blank, or outside the fields) must stay transparent
+    if len(child_tiles) < 4:
+        channels = 4
+    else:
+        channels = max(child.shape[2] for child in child_tiles.values())
+    mosaic = np.zeros((512, 512, channels), dtype=np.uint8)
+    for (dx, dy), child in child_tiles.items():
+        mosaic[dy * 256:(dy + 1) * 256, dx * 256:(dx + 1) * 256, :child.shape[2]] = child
+        if child.shape[2] < channels:
+            mosaic[dy * 256:(dy + 1) * 256, dx * 256:(dx + 1) * 256, 3] = 255
+    
+    img = Image.fromarray(mosaic, mode='RGBA' if channels == 4 else 'RGB')
+    img = img.resize((256, 256), Image.Resampling.LANCZOS)
+    return np.array(img)
+
+def build_parent_tiles(store, zoom, tiles, write_tile, stats, encoder=None, palette=None):
+    """Build a list of (x, y) tiles from the zoom + 1 level, passing each to write_tile.
+    
+    Tiles are encoded with encoder (RGB PNG by default); png8 tiles are
+    quantized back to palette. Tiles without children are counted in
+    stats['blank']. Returns error messages for failed tiles.
+    """
+    errors = []
+    encode_cache = {}
+    encoder = encoder or TileEncoder()
+    
+    for tile_x, tile_y in tiles:
+        try:
+            rgb_data = build_parent_tile(store, zoom, tile_x, tile_y)
+            if rgb_data is None:
+                stats['blank'] += 1
+                continue
             
-            # Calculate tile bounds for this zoom level
-            min_tile_x, max_tile_y = deg2num(bounds.top, bounds.left, zoom)
-            max_tile_x, min_tile_y = deg2num(bounds.bottom, bounds.right, zoom)
+            tile_bytes = encode_tile_cached(rgb_data, encode_cache,
+                                            lambda rgb: encoder.encode(rgb, palette), stats)
+            write_tile(zoom, tile_x, tile_y, tile_bytes)
             
-            zoom_dir = layer_dir / str(zoom)
-            zoom_dir.mkdir(exist_ok=True)
+        except Exception as e:
+            errors.append(f"{zoom}/{tile_x}/{tile_y}: {e}")
+            continue
+    
+    return errors
+
+# Per-process Web Mercator view used by the parallel tiler
+_worker_src = None
+
+def _init_tile_worker(geotiff_path):
+    """Open a rasterio handle and warped view for this worker process."""
+    global _worker_src
+    _worker_src = open_web_mercator_view(rasterio.open(geotiff_path))
+
+def _render_tile_shard(zoom, tiles, band_type, metatile_size, palette, encoder, bands, value_range):
+    """Render a shard of tiles with the worker's own dataset handle."""
+    payloads = []
+    stats = Counter()
+    errors = render_tiles(_worker_src, zoom, tiles, band_type,
+                          lambda *tile: payloads.append(tile), stats, metatile_size, palette,
+                          encoder, bands, value_range)
+    return payloads, errors, stats
+
+def _build_parent_shard(zoom, tiles, store, encoder, palette):
+    """Build a shard of parent tiles from the store's zoom + 1 level."""
+    payloads = []
+    stats = Counter()
+    errors = build_parent_tiles(store, zoom, tiles, lambda *tile: payloads.append(tile), stats,
+                                encoder, palette)
+    return payloads, errors, stats
+
+def timed_writer(write_tile, stats):
+    """Wrap write_tile so that written tiles are counted in stats['written'] and timed in stats['write_seconds']."""
+    def write(zoom, tile_x, tile_y, tile_bytes):
+        start = time.perf_counter()
+        write_tile(zoom, tile_x, tile_y, tile_bytes)
+        stats['write_seconds'] += time.perf_counter() - start
+        stats['written'] += 1
+    return write
+
+def _run_tile_shards(executor, workers, store, stats, shard_func, zoom, tiles, *args,
+                     metatile_size=1):
+    """Shard the tiles across the pool and write the returned tiles to the store.
+    
+    Only the parent process writes, so single-writer backends such as MBTiles
+    work with any number of workers. Shards are written as they finish, and
+    at most SHARDS_IN_FLIGHT_PER_WORKER shards per worker are submitted at a
+    time, so a slow shard never leaves a zoom level's output waiting in memory.
+    """
+    # A few shards per worker keeps the pool busy when shards are uneven
+    shard_size = max(1, min(math.ceil(len(tiles) / (workers * 4)), SHARD_MAX_TILES))
+    
+    def metatile_of(tile):
+        return (tile[0] // metatile_size, tile[1] // metatile_size)
+    
+    errors = []
+    write_tile = timed_writer(store.write_tile, stats)
+    
+    def collect(done):
+        for future in done:
+            payloads, shard_errors, shard_stats = future.result()
+            for tile in payloads:
+                write_tile(*tile)
+            errors.extend(shard_errors)
+            stats.update(shard_stats)
+    
+    pending = set()
+    start = 0
+    while start < len(tiles):
+        end = min(start + shard_size, len(tiles))
+        # Extend the shard so a metatile is never split between workers
+        while end < len(tiles) and metatile_of(tiles[end]) == metatile_of(tiles[end - 1]):
+            end += 1
+        if len(pending) >= workers * SHARDS_IN_FLIGHT_PER_WORKER:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            collect(done)
+        pending.add(executor.submit(shard_func, zoom, tiles[start:end], *args))
+        start = end
+    
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        collect(done)
+    return errors
+
+def create_tiles_for_geotiff(geotiff_path, output_dir, min_zoom=10, max_zoom=16, workers=1,
+                             pyramid=False, output_format="xyz", metatile_size=1, palette=None,
+                             tile_encoding="png", encode_level=None, fields_path=None, field_buffer=0,
+                             bands=None, stats=None):
+    """Create XYZ tiles from a GeoTIFF file.
+    
+    With workers > 1 the tiles of each zoom level are split into shards and
+    rendered by a process pool, each worker holding its own rasterio handle.
+    
+    With pyramid=True only max_zoom is rendered from the GeoTIFF; every lower
+    zoom is built bottom-up by downsampling the four child tiles at zoom + 1.
+    
+    output_format is "xyz" for a layer/z/x/y.png tree, "mbtiles" for a
+    single layer.mbtiles file or "pmtiles" for a single layer.pmtiles archive.
+    
+    metatile_size > 1 reads and normalizes blocks of metatile_size x
+    metatile_size tiles in one call before slicing them into tiles.
+    
+    palette names a colormap palette (e.g. "ndvi", "evi", "moisture", "soil");
+    by default the layer's band type picks one.
+    
+    tile_encoding is one of TileEncoder.FORMATS, with encode_level as the PNG
+    compression level or WebP quality.
+    
+    fields_path points at a polygon GeoJSON (e.g. estate_fields.geojson);
+    only tiles touching those polygons, grown by field_buffer tiles, are
+    rendered.
+    
+    bands lists the 1-based band indexes rendered as red, green and blue in
+    true colour; composite layers such as Agriculture default to their
+    first three bands (see get_composite_bands). Other layers render band 1
+    through a palette.
+    
+    stats is an optional Counter that receives the run's tile counts and
+    per-stage timings (see benchmark_tiles.py).
+    """
+    
+    geotiff_path = Path(geotiff_path)
+    layer_name = geotiff_path.stem
+    band_type = get_band_type(layer_name)
+    palette = palette or palette_for_layer(band_type)
+    encoder = TileEncoder(tile_encoding, encode_level)
+    # Bad bands fail here, before any output is created
+    with rasterio.open(geotiff_path) as dataset:
+        bands = select_bands(layer_name, dataset.count, bands)
+    
+    print(f"Processing {layer_name} (type: {band_type})...")
+    
+    store = open_tile_store(output_dir, layer_name, output_format, encoder.extension)
+    stats = stats if stats is not None else Counter()
+    write_tile = timed_writer(store.write_tile, stats)
+    field_geometries = load_field_geometries(fields_path) if fields_path else None
+    
+    executor = None
+    if workers > 1:
+        executor = ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_init_tile_worker,
+            initargs=(str(geotiff_path),)
+        )
+    
+    try:
+        with rasterio.open(geotiff_path) as dataset, open_web_mercator_view(dataset) as src:
+            bounds = get_geographic_bounds(dataset)
             
-            for tile_x in range(min_tile_x, max_tile_x + 1):
-                x_dir = zoom_dir / str(tile_x)
-                x_dir.mkdir(exist_ok=True)
-                
-                for tile_y in range(min_tile_y, max_tile_y + 1):
-                    # Calculate tile bounds in geographic coordinates
-                    north, west = num2deg(tile_x, tile_y, zoom)
-                    south, east = num2deg(tile_x + 1, tile_y + 1, zoom)
-                    
-                    # Check if tile intersects with raster bounds
-                    if (east < bounds.left or west > bounds.right or 
-                        north < bounds.bottom or south > bounds.top):
-                        continue
-                    
-                    try:
-                        # Read data for this tile extent
-                        window = rasterio.windows.from_bounds(
-                            west, south, east, north, src.transform
-                        )
-                        
-                        # Read the first band (main data)
-                        data = src.read(1, window=window)
-                        
-                        if data.size == 0 or np.all(np.isnan(data)):
-                            continue
-                        
-                        # Resize to 256x256 (standard tile size)
-                        if data.shape != (256, 256):
-                            # Use PIL for resizing
-                            img_data = normalize_band_for_display(data, band_type)
-                            img = Image.fromarray(img_data, mode='L')
-                            img = img.resize((256, 256), Image.Resampling.LANCZOS)
-                            tile_data = np.array(img)
-                        else:
-                            tile_data = normalize_band_for_display(data, band_type)
-                        
-                        # Create RGB image (grayscale to RGB for vegetation indices)
-                        if band_type == "vegetation":
-                            # Create a green-scale colormap for vegetation
-                            rgb_data = np.zeros((256, 256, 3), dtype=np.uint8)
-                            rgb_data[:, :, 1] = tile_data  # Green channel
-                            rgb_data[:, :, 0] = tile_data // 2  # Some red for mixed colors
-                        elif band_type == "moisture":
-                            # Create a blue-scale colormap for moisture
-                            rgb_data = np.zeros((256, 256, 3), dtype=np.uint8)
-                            rgb_data[:, :, 2] = tile_data  # Blue channel
-                            rgb_data[:, :, 0] = tile_data // 3  # Some red
-                        else:
-                            # Grayscale
-                            rgb_data = np.stack([tile_data, tile_data, tile_data], axis=2)
-                        
-                        # Save as PNG
-                        tile_path = x_dir / f"{tile_y}.png"
-                        img = Image.fromarray(rgb_data, mode='RGB')
-                        img.save(tile_path, 'PNG')
-                        
-                    except Exception as e:
-                        print(f"    Error creating tile {zoom}/{tile_x}/{tile_y}: {e}")
-                        continue
+            if bands:
+                print(f"  True colour from bands {', '.join(str(band) for band in bands)}")
+                palette = None
+                # Each band is stretched between its own cached percentiles
+                value_range = band_value_ranges(geotiff_path, bands, dataset.dtypes[bands[0] - 1])
+                print("  Stretch: " + ", ".join(f"{low:.4f} to {high:.4f}" for low, high in value_range))
+            else:
+                # One stretch for the whole layer, from its cached statistics
+                value_range = layer_value_range(geotiff_path, band_type)
+                if value_range is not None:
+                    print(f"  Stretch: {value_range[0]:.4f} to {value_range[1]:.4f}")
+            
+            store.write_metadata({
+                'name': layer_name,
+                'format': encoder.extension,
+                'type': 'overlay',
+                'version': '1.0',
+                'bounds': f"{bounds.left},{bounds.bottom},{bounds.right},{bounds.top}",
+                'minzoom': min_zoom,
+                'maxzoom': max_zoom,
+            })
+            
+            if pyramid:
+                zooms = range(max_zoom, min_zoom - 1, -1)
+            else:
+                zooms = range(min_zoom, max_zoom + 1)
             
-            print(f"    Completed zoom level {zoom}")
+            for zoom in zooms:
+                print(f"  Creating zoom level {zoom}...")
+                
+                # Calculate tile bounds for this zoom level
+                min_tile_x, max_tile_x, min_tile_y, max_tile_y = tile_range(bounds, zoom)
+                store.prepare_zoom(zoom, min_tile_x, max_tile_x)
+                
+                # The zoom level's tiles are selected and ordered as arrays, and only
+                # turned into a list of [x, y] pairs once
+                xs, ys = range_tiles(min_tile_x, max_tile_x, min_tile_y, max_tile_y)
+                
+                # Only render tiles over the field polygons
+                if field_geometries is not None:
+                    field_mask = field_tile_mask(field_geometries, zoom, min_tile_x, max_tile_x,
+                                                 min_tile_y, max_tile_y, field_buffer)
+                    total_tiles = len(xs)
+                    in_fields = field_mask[ys - min_tile_y, xs - min_tile_x]
+                    xs, ys = xs[in_fields], ys[in_fields]
+                    print(f"    {len(xs)} of {total_tiles} tiles intersect fields")
+                
+                # Keep each metatile's tiles together so shards rarely split one
+                if metatile_size > 1:
+                    order = np.lexsort((ys // metatile_size, xs // metatile_size))
+                    xs, ys = xs[order], ys[order]
+                
+                tiles = np.column_stack((xs, ys)).tolist()
+                
+                if pyramid and zoom < max_zoom:
+                    if executor is None:
+                        errors = build_parent_tiles(store, zoom, tiles, write_tile, stats,
+                                                    encoder, palette)
+                    else:
+                        errors = _run_tile_shards(executor, workers, store, stats,
+                                                  _build_parent_shard, zoom, tiles, store,
+                                                  encoder, palette)
+                elif executor is None:
+                    errors = render_tiles(src, zoom, tiles, band_type, write_tile, stats,
+                                          metatile_size, palette, encoder, bands, value_range)
+                else:
+                    errors = _run_tile_shards(executor, workers, store, stats, _render_tile_shard,
+                                              zoom, tiles, band_type, metatile_size, palette,
+                                              encoder, bands, value_range,
+                                              metatile_size=metatile_size)
+                
+                # Make the level visible to workers building the next pyramid level
+                start = time.perf_counter()
+                store.flush()
+                stats['write_seconds'] += time.perf_counter() - start
+                
+                for error in errors:
+                    print(f"    Error creating tile {error}")
+                
+                print(f"    Completed zoom level {zoom}")
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        start = time.perf_counter()
+        store.close()
+        stats['write_seconds'] += time.perf_counter() - start
     
+    print(f"  Source reads: {stats['reads']} (metatile size {metatile_size}), "
+          f"{stats['culled']} blocks culled from the mask")
+    if stats['encoded']:
+        print(f"  Encoded {stats['encoded']} {tile_encoding} tiles: "
+              f"{stats['encoded_bytes'] / stats['encoded']:.0f} bytes/tile, "
+              f"{stats['encode_seconds'] / stats['encoded'] * 1000:.1f} ms/tile")
+    print(f"  Skipped {stats['blank']} blank tiles, deduplicated {store.deduplicated} identical tiles")
     print(f"✅ Completed tiles for {layer_name}")
-    return layer_dir
+    return store.path
+
+# (tile_encoding, encode_level) pairs compared by compare_tile_encodings
+ENCODING_COMPARISONS = [
+    ("png", 1), ("png", 6), ("png", 9),
+    ("png8", 6), ("png8", 9),
+    ("webp", 50), ("webp", 80), ("webp-lossless", 80),
+]
+
+def compare_tile_encodings(geotiff_path, zoom, sample_size=50, palette=None, bands=None):
+    """Encode a sample of tiles at one zoom in each tile encoding and report size and speed.
+    
+    Returns a list of dicts with the encoding, level, bytes_per_tile and
+    ms_per_tile (including colour mapping for the RGB encodings).
+    
+    Composite layers, or any layer given bands, are sampled as the true
+    colour tiles create_tiles_for_geotiff renders for them; their png8 row
+    quantizes the RGB tiles, since palette-indexed tiles are never made.
+    """
+    geotiff_path = Path(geotiff_path)
+    layer_name = geotiff_path.stem
+    band_type = get_band_type(layer_name)
+    palette = palette or palette_for_layer(band_type)
+    samples = []
+    
+    with rasterio.open(geotiff_path) as dataset, open_web_mercator_view(dataset) as src:
+        bands = select_bands(layer_name, dataset.count, bands)
+        if bands:
+            value_range = band_value_ranges(geotiff_path, bands, dataset.dtypes[bands[0] - 1])
+        else:
+            value_range = layer_value_range(geotiff_path, band_type)
+        
+        min_tile_x, max_tile_x, min_tile_y, max_tile_y = tile_range(get_geographic_bounds(dataset), zoom)
+        xs, ys = range_tiles(min_tile_x, max_tile_x, min_tile_y, max_tile_y)
+        
+        # Spread the sample over the whole layer
+        step = max(1, len(xs) // sample_size)
+        for window in metatile_windows(src, zoom, np.column_stack((xs[::step], ys[::step]))):
+            block = read_tile_block(src, window, band_type, bands=bands, value_range=value_range)
+            if block is not None:
+                samples.append(block[0])
+            if len(samples) >= sample_size:
+                break
+    
+    print(f"Encoding comparison for {layer_name} at zoom {zoom} ({len(samples)} tiles):")
+    if not samples:
+        return []
+    
+    results = []
+    for tile_encoding, encode_level in ENCODING_COMPARISONS:
+        encoder = TileEncoder(tile_encoding, encode_level)
+        total_bytes = 0
+        start = time.perf_counter()
+        for tile_data in samples:
+            if bands:
+                tile_bytes = encoder.encode(tile_data)
+            elif tile_encoding == "png8":
+                tile_bytes = encoder.encode_indexed(tile_data, palette)
+            else:
+                tile_bytes = encoder.encode(colorize_tile(tile_data, band_type, palette), palette)
+            total_bytes += len(tile_bytes)
+        elapsed = time.perf_counter() - start
+        
+        result = {
+            'encoding': tile_encoding,
+            'level': encode_level,
+            'bytes_per_tile': total_bytes / len(samples),
+            'ms_per_tile': elapsed / len(samples) * 1000,
+        }
+        results.append(result)
+        print(f"  {tile_encoding:<14} level {encode_level:>3}: "
+              f"{result['bytes_per_tile']:>8.0f} bytes/tile, {result['ms_per_tile']:6.1f} ms/tile")
+    
+    return results
+
+class TileCache:
+    """Thread-safe LRU cache of encoded tiles, bounded by their total size in bytes.
+    
+    Each entry counts CACHE_ENTRY_OVERHEAD_BYTES on top of its tile bytes,
+    so the budget also bounds the number of (possibly empty) entries.
+    With a spill_dir, tiles evicted from memory are written there and read
+    back on a later miss instead of being rendered again. Hits, spill hits
+    and misses are counted in stats.
+    """
+    
+    def __init__(self, max_bytes=DYNAMIC_CACHE_BYTES, spill_dir=None):
+        self.max_bytes = max_bytes
+        self.spill_dir = Path(spill_dir).resolve() if spill_dir else None
+        self.tiles = OrderedDict()
+        self.size = 0
+        self.stats = Counter()
+        self._lock = threading.Lock()
+    
+    def _spill_path(self, key):
+        layer_name, zoom, tile_x, tile_y = key
+        return self.spill_dir / layer_name / str(zoom) / str(tile_x) / f"{tile_y}.tile"
+    
+    def get(self, key):
+        """Return the cached bytes for a (layer, z, x, y) key, or None on a miss."""
+        with self._lock:
+            tile_bytes = self.tiles.get(key)
+            if tile_bytes is not None:
+                self.tiles.move_to_end(key)
+                self.stats['hits'] += 1
+                return tile_bytes
+        
+        if self.spill_dir is not None:
+            try:
+                tile_bytes = self._spill_path(key).read_bytes()
+            except OSError:
+                pass
+            else:
+                with self._lock:
+                    self.stats['spill_hits'] += 1
+                self.put(key, tile_bytes)
+                return tile_bytes
+        
+        with self._lock:
+            self.stats['misses'] += 1
+        return None
+    
+    def entry_size(self, tile_bytes):
+        """Return the bytes a cached tile counts against max_bytes."""
+        return len(tile_bytes) + CACHE_ENTRY_OVERHEAD_BYTES
+    
+    def cached_bytes(self, key):
+        """Return the bytes a key's tile counts against max_bytes, or 0 if it is not in memory."""
+        with self._lock:
+            tile_bytes = self.tiles.get(key)
+        return 0 if tile_bytes is None else self.entry_size(tile_bytes)
+    
+    def put(self, key, tile_bytes):
+        """Cache tile bytes, evicting (and spilling) the least recently used tiles."""
+        evicted = []
+        with self._lock:
+            if key in self.tiles:
+                self.size -= self.entry_size(self.tiles.pop(key))
+            self.tiles[key] = tile_bytes
+            self.size += self.entry_size(tile_bytes)
+            while self.size > self.max_bytes and len(self.tiles) > 1:
+                old_key, old_bytes = self.tiles.popitem(last=False)
+                self.size -= self.entry_size(old_bytes)
+                evicted.append((old_key, old_bytes))
+        
+        if self.spill_dir is None:
+            return
+        for old_key, old_bytes in evicted:
+            spill_path = self._spill_path(old_key)
+            if spill_path.exists():
+                continue
+            spill_path.parent.mkdir(parents=True, exist_ok=True)
+            # Write then rename so readers never see a partial tile
+            temp_path = spill_path.with_name(f"{spill_path.name}.{threading.get_ident()}.tmp")
+            temp_path.write_bytes(old_bytes)
+            os.replace(temp_path, spill_path)
+
+class DynamicTileRenderer:
+    """Renders tiles on request straight from the GeoTIFFs in tiff_dir.
+    
+    A layer is a GeoTIFF's file stem, as in create_tiles_for_geotiff, read
+    from its optimized copy where there is one. Tiles go through the same
+    windowing, normalization and encoding path as pre-rendered tiles.
+    Rasterio handles and Web Mercator views stay open in a small pool per
+    layer, shared by all connection threads, and each layer's extent, bands
+    and stretch are worked out once, so a cache hit opens nothing. Encoded
+    tiles are held in a TileCache.
+    """
+    
+    def __init__(self, tiff_dir, cache=None, palette=None, tile_encoding="png", encode_level=None):
+        self.tiff_dir = Path(tiff_dir).resolve()
+        self.cache = cache if cache is not None else TileCache()
+        self.palette = palette
+        self.encoder = TileEncoder(tile_encoding, encode_level)
+        self._views = {}
+        self._layer_info = {}
+        self._lock = threading.Lock()
+    
+    def layer_path(self, layer_name):
+        """Return the GeoTIFF behind a layer name, or None if there is none.
+        
+        The optimized copy from optimize_geotiffs.py is used where it is up to
+        date, as in the tiler, so both read the same file and stretch it with
+        the same statistics.
+        """
+        if layer_name.startswith("."):
+            return None
+        for suffix in (".tiff", ".tif"):
+            path = self.tiff_dir / f"{layer_name}{suffix}"
+            if path.is_file():
+                return optimized_path(path) if is_up_to_date(path) else path
+        return None
+    
+    def layers(self):
+        """Return the names of all layers that can be rendered."""
+        return sorted(path.stem for path in find_tiff_files(self.tiff_dir))
+    
+    @contextlib.contextmanager
+    def view(self, layer_name):
+        """Borrow an open Web Mercator view of a layer from its pool, opening one if none is free.
+        
+        Up to VIEW_POOL_SIZE views per layer are kept open when returned.
+        """
+        with self._lock:
+            pool = self._views.setdefault(layer_name, [])
+            src = pool.pop() if pool else None
+        if src is None:
+            src = open_web_mercator_view(rasterio.open(self.layer_path(layer_name)))
+        try:
+            yield src
+        finally:
+            with self._lock:
+                keep = len(pool) < VIEW_POOL_SIZE
+                if keep:
+                    pool.append(src)
+            if not keep:
+                dataset = src.src_dataset
+                src.close()
+                dataset.close()
+    
+    def layer_info(self, layer_name):
+        """Return a layer's Web Mercator bounds, true-colour bands and display stretch.
+        
+        Bands are None for single-band layers and are picked from the source
+        dataset's band count, as the pre-rendered tiles pick them (the view's
+        count can include an alpha band added by the warp). Composite layers
+        get one (min, max) stretch per band. Worked out on first use from the
+        cached statistics and kept.
+        """
+        info = self._layer_info.get(layer_name)
+        if info is None:
+            with self.view(layer_name) as src:
+                bands = get_composite_bands(layer_name, src.src_dataset.count)
+                if bands:
+                    value_range = band_value_ranges(self.layer_path(layer_name), bands,
+                                                    src.dtypes[bands[0] - 1])
+                else:
+                    value_range = layer_value_range(self.layer_path(layer_name), get_band_type(layer_name))
+                info = self._layer_info[layer_name] = (src.bounds, bands, value_range)
+        return info
+    
+    def covers_tile(self, layer_name, zoom, tile_x, tile_y):
+        """Check whether a tile exists at its zoom level and overlaps the layer's extent."""
+        if zoom < 0 or not (0 <= tile_x < 2 ** zoom and 0 <= tile_y < 2 ** zoom):
+            return False
+        west, south, east, north = tile_bounds(tile_x, tile_y, zoom)
+        bounds = self.layer_info(layer_name)[0]
+        return west < bounds.right and east > bounds.left and south < bounds.top and north > bounds.bottom
+    
+    def get_tile(self, layer_name, zoom, tile_x, tile_y):
+        """Return encoded tile bytes, b"" for a tile with no data, or None for an unknown layer."""
+        if self.layer_path(layer_name) is None:
+            return None
+        
+        # Tiles off the layer are blank without rendering, and are not cached
+        # so that requests for arbitrary coordinates cannot fill the cache
+        if not self.covers_tile(layer_name, zoom, tile_x, tile_y):
+            return b""
+        
+        key = (layer_name, zoom, tile_x, tile_y)
+        tile_bytes = self.cache.get(key)
+        if tile_bytes is not None:
+            return tile_bytes
+        
+        rendered = []
+        _, bands, value_range = self.layer_info(layer_name)
+        with self.view(layer_name) as src:
+            errors = render_tiles(src, zoom, [(tile_x, tile_y)], get_band_type(layer_name),
+                                  lambda *tile: rendered.append(tile[3]), Counter(),
+                                  palette=self.palette, encoder=self.encoder,
+                                  bands=bands, value_range=value_range)
+        if errors:
+            raise RuntimeError(errors[0])
+        
+        # Blank tiles within the extent are cached too, so they are not read again
+        tile_bytes = rendered[0] if rendered else b""
+        self.cache.put(key, tile_bytes)
+        return tile_bytes
 
 def create_simple_tile_server():
     """Create a simple Python HTTP server script for serving tiles."""
@@ -163,38 +1480,544 @@ def create_simple_tile_server():
 """
 Simple tile server for serving XYZ tiles locally.
 Run this script and access tiles at: http://localhost:8000/{layer_name}/{z}/{x}/{y}.png
+Layers are served from tiles/{layer_name}/ directories, or from tiles/{layer_name}.mbtiles
+or tiles/{layer_name}.pmtiles files. PMTiles directories are kept in memory and
+tiles are read from the archive with positional byte-range reads.
+
+With --dynamic, tiles that were not pre-rendered are rendered on request
+straight from the GeoTIFFs (see DynamicTileRenderer in create_tile_server.py)
+and kept in a memory-bounded LRU cache, optionally spilling to disk:
+    python tile_server.py --dynamic "Browser_images (2)_clean" --cache-mb 128
+
+Each connection is handled on its own thread with HTTP/1.1 keep-alive.
+Tiles carry ETag, Last-Modified and Cache-Control headers, and conditional
+requests for unchanged tiles get a 304 Not Modified reply. Missing tiles get
+an empty, briefly cacheable 404 that keeps the connection open.
+
+Served tiles are counted per layer in tiles/.access/{layer_name}.counts.
+--prewarm N renders or loads the N most requested tile positions of every
+layer at startup, and POST /_prewarm?tiles=N does the same while running.
+--prewarm-layer and layer= limit warming to one layer, e.g. a newly
+ingested scene:
+    curl -X POST "http://localhost:8000/_prewarm?tiles=500&layer=2019-06-03_NDVI"
+Warming stops once the tiles warmed fill the dynamic cache budget. Only one
+prewarm runs at a time; POST /_prewarm answers 409 Conflict while one is.
 """
 
+import argparse
+import bisect
+import gzip
+import hashlib
 import http.server
-import socketserver
+import itertools
+import sqlite3
 import os
+import re
+import struct
+import threading
+import time
+from collections import Counter
+from email.utils import formatdate, parsedate_to_datetime
 from pathlib import Path
+from urllib.parse import parse_qs, urlsplit
+
+# Tile numbering shared with the tiler (tile_grid.py sits next to this script)
+from tile_grid import tms_row, zxy_to_tile_id
 
 PORT = 8000
-TILES_DIR = Path(__file__).parent / "tiles"
+TILES_DIR = Path(__file__).resolve().parent / "tiles"
+TILE_PATH = re.compile(r"^/([^/]+)/(\\d+)/(\\d+)/(\\d+)\\.(png|webp)$")
+
+# Seconds an idle keep-alive connection is kept open
+KEEP_ALIVE_TIMEOUT = 15
+
+# Seconds browsers may reuse a tile before revalidating it
+CACHE_MAX_AGE = 30 * 24 * 3600
+
+# Seconds browsers may remember a missing (blank or skipped) tile; short, since
+# a newly ingested scene or a dynamic renderer can fill it in later
+MISSING_TILE_MAX_AGE = 3600
+
+# Per-layer tile request counters: one (zoom, x, y, count) record per tile position
+ACCESS_DIR = TILES_DIR / ".access"
+ACCESS_RECORD = struct.Struct("<BIII")
+ACCESS_FLUSH_SECONDS = 60
+
+# Default number of tile positions warmed by POST /_prewarm
+PREWARM_TILES = 500
+
+# Held while a prewarm runs, so that repeated requests cannot start more
+prewarm_lock = threading.Lock()
+
+# Per-thread MBTiles connections, keyed by layer name
+thread_state = threading.local()
+
+# PMTiles archives opened so far, keyed by layer name
+pmtiles_archives = {}
+
+# (mtime_ns, tile extension) of the MBTiles files read so far, keyed by layer name
+mbtiles_formats = {}
+PMTILES_HEADER = struct.Struct("<7sB11Q6B4iB2i")
+PMTILES_EXTENSIONS = {2: "png", 4: "webp"}
+
+# DynamicTileRenderer used for tiles that were not pre-rendered (--dynamic)
+renderer = None
+
+def read_mbtiles_tile(layer_name, zoom, tile_x, tile_y):
+    """Return tile bytes from tiles/{layer_name}.mbtiles, or None if missing."""
+    connections = getattr(thread_state, "mbtiles_connections", None)
+    if connections is None:
+        connections = thread_state.mbtiles_connections = {}
+    
+    if layer_name not in connections:
+        mbtiles_path = TILES_DIR / f"{layer_name}.mbtiles"
+        if not mbtiles_path.exists():
+            return None
+        connections[layer_name] = sqlite3.connect(f"file:{mbtiles_path}?mode=ro", uri=True)
+    
+    # MBTiles rows are stored in TMS order
+    tile_row = tms_row(zoom, tile_y)
+    row = connections[layer_name].execute(
+        "SELECT tile_data FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+        (zoom, tile_x, tile_row)
+    ).fetchone()
+    return bytes(row[0]) if row else None
+
+def read_varints(data):
+    value = shift = 0
+    for byte in data:
+        value |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            yield value
+            value = shift = 0
+
+def decode_pmtiles_directory(data):
+    """Decode a PMTiles directory into a sorted tile id list and (offset, length, run_length) entries."""
+    numbers = read_varints(data)
+    count = next(numbers)
+    tile_ids = list(itertools.accumulate(next(numbers) for _ in range(count)))
+    run_lengths = [next(numbers) for _ in range(count)]
+    lengths = [next(numbers) for _ in range(count)]
+    offsets = []
+    for index in range(count):
+        value = next(numbers)
+        if value == 0 and index > 0:
+            offsets.append(offsets[-1] + lengths[index - 1])
+        else:
+            offsets.append(value - 1)
+    return tile_ids, list(zip(offsets, lengths, run_lengths))
+
+class PMTilesArchive:
+    """Read-only PMTiles (v3) archive whose directories are cached in memory.
+    
+    Tiles are read with os.pread on one shared file descriptor, so threads
+    need no locking and a lookup never touches the filesystem tree.
+    """
+    
+    def __init__(self, path):
+        self.fd = os.open(path, os.O_RDONLY)
+        stat = os.fstat(self.fd)
+        self.mtime, self.mtime_ns = stat.st_mtime, stat.st_mtime_ns
+        header = PMTILES_HEADER.unpack(os.pread(self.fd, PMTILES_HEADER.size, 0))
+        if header[0] != b"PMTiles" or header[1] != 3:
+            raise ValueError(f"{path} is not a PMTiles v3 archive")
+        root_offset, root_length, _, _, self.leaf_offset, _, self.data_offset = header[2:9]
+        self.compressed = header[14] == 2
+        self.extension = PMTILES_EXTENSIONS.get(header[16], "png")
+        self.root = self.read_directory(root_offset, root_length)
+        self.leaves = {}
+    
+    def __del__(self):
+        if hasattr(self, "fd"):
+            os.close(self.fd)
+    
+    def read_directory(self, offset, length):
+        data = os.pread(self.fd, length, offset)
+        return decode_pmtiles_directory(gzip.decompress(data) if self.compressed else data)
+    
+    def get_tile(self, zoom, tile_x, tile_y):
+        """Return tile bytes, or None if the archive has no such tile."""
+        tile_id = zxy_to_tile_id(zoom, tile_x, tile_y)
+        tile_ids, entries = self.root
+        # The root plus at most three levels of leaf directories
+        for _ in range(4):
+            index = bisect.bisect_right(tile_ids, tile_id) - 1
+            if index < 0:
+                return None
+            offset, length, run_length = entries[index]
+            if run_length > 0:
+                if tile_id >= tile_ids[index] + run_length:
+                    return None
+                return os.pread(self.fd, length, self.data_offset + offset)
+            
+            leaf = self.leaves.get(offset)
+            if leaf is None:
+                leaf = self.leaves[offset] = self.read_directory(self.leaf_offset + offset, length)
+            tile_ids, entries = leaf
+        return None
+
+def open_pmtiles(pmtiles_path):
+    """Return the cached PMTilesArchive for a file, reopening it if the file was replaced."""
+    archive = pmtiles_archives.get(pmtiles_path.stem)
+    if archive is None or archive.mtime_ns != pmtiles_path.stat().st_mtime_ns:
+        archive = pmtiles_archives[pmtiles_path.stem] = PMTilesArchive(pmtiles_path)
+    return archive
+
+def mbtiles_extension(mbtiles_path):
+    """Return the tile extension of an MBTiles file, cached until the file is replaced."""
+    mtime_ns = mbtiles_path.stat().st_mtime_ns
+    cached = mbtiles_formats.get(mbtiles_path.stem)
+    if cached is None or cached[0] != mtime_ns:
+        cached = mbtiles_formats[mbtiles_path.stem] = (mtime_ns, tile_extension(mbtiles_path))
+    return cached[1]
+
+def load_tile(layer_name, zoom, tile_x, tile_y, extension):
+    """Return (tile_bytes, etag, last_modified) for a tile, or None if it does not exist."""
+    if layer_name.startswith("."):
+        return None
+    
+    mbtiles_path = TILES_DIR / f"{layer_name}.mbtiles"
+    pmtiles_path = TILES_DIR / f"{layer_name}.pmtiles"
+    # Archives hold tiles in one format; other extensions are not found, like
+    # missing files in a layer directory
+    if pmtiles_path.exists():
+        archive = open_pmtiles(pmtiles_path)
+        tile_bytes = archive.get_tile(zoom, tile_x, tile_y) if extension == archive.extension else None
+        if tile_bytes is not None:
+            etag = '"' + hashlib.sha1(tile_bytes).hexdigest() + '"'
+            return tile_bytes, etag, archive.mtime
+    elif mbtiles_path.exists():
+        tile_bytes = None
+        if extension == mbtiles_extension(mbtiles_path):
+            tile_bytes = read_mbtiles_tile(layer_name, zoom, tile_x, tile_y)
+        if tile_bytes is not None:
+            etag = '"' + hashlib.sha1(tile_bytes).hexdigest() + '"'
+            return tile_bytes, etag, mbtiles_path.stat().st_mtime
+    else:
+        tile_path = TILES_DIR / layer_name / str(zoom) / str(tile_x) / f"{tile_y}.{extension}"
+        try:
+            stat = tile_path.stat()
+            return tile_path.read_bytes(), f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"', stat.st_mtime
+        except OSError:
+            pass
+    
+    if renderer is not None and extension == renderer.encoder.extension:
+        tile_bytes = renderer.get_tile(layer_name, zoom, tile_x, tile_y)
+        if tile_bytes:
+            etag = '"' + hashlib.sha1(tile_bytes).hexdigest() + '"'
+            return tile_bytes, etag, renderer.layer_path(layer_name).stat().st_mtime
+    return None
+
+def list_layers():
+    """Return sorted (layer_name, extension) pairs for all pre-rendered and dynamic layers."""
+    layers = {}
+    for layer_path in TILES_DIR.iterdir():
+        if layer_path.name.startswith("."):
+            continue
+        if layer_path.is_dir():
+            layers[layer_path.name] = tile_extension(layer_path)
+        elif layer_path.suffix in (".mbtiles", ".pmtiles"):
+            layers[layer_path.stem] = tile_extension(layer_path)
+    if renderer is not None:
+        for layer_name in renderer.layers():
+            layers.setdefault(layer_name, renderer.encoder.extension)
+    return sorted(layers.items())
+
+class AccessCounter:
+    """Counts tile requests per layer and periodically merges them into ACCESS_DIR."""
+    
+    def __init__(self, access_dir=ACCESS_DIR):
+        self.access_dir = access_dir
+        self.pending = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+    
+    def record(self, layer_name, zoom, tile_x, tile_y):
+        with self._lock:
+            self.pending.setdefault(layer_name, Counter())[(zoom, tile_x, tile_y)] += 1
+    
+    def load(self, layer_name):
+        """Return the saved Counter of (zoom, x, y) requests for a layer."""
+        try:
+            data = (self.access_dir / f"{layer_name}.counts").read_bytes()
+        except OSError:
+            return Counter()
+        return Counter({(zoom, tile_x, tile_y): count
+                        for zoom, tile_x, tile_y, count in ACCESS_RECORD.iter_unpack(data)})
+    
+    def flush(self):
+        """Add the pending counts to each layer's counts file."""
+        with self._flush_lock:
+            with self._lock:
+                pending, self.pending = self.pending, {}
+            if not pending:
+                return
+            
+            self.access_dir.mkdir(exist_ok=True)
+            for layer_name, new_counts in pending.items():
+                counts = self.load(layer_name)
+                counts.update(new_counts)
+                data = b"".join(ACCESS_RECORD.pack(*tile, min(count, 0xFFFFFFFF))
+                                for tile, count in counts.items())
+                counts_path = self.access_dir / f"{layer_name}.counts"
+                temp_path = counts_path.with_suffix(".tmp")
+                temp_path.write_bytes(data)
+                os.replace(temp_path, counts_path)
+    
+    def run_flusher(self, interval=ACCESS_FLUSH_SECONDS):
+        """Flush the counts every interval seconds in a background thread."""
+        def flush_forever():
+            while True:
+                time.sleep(interval)
+                self.flush()
+        threading.Thread(target=flush_forever, daemon=True).start()
+    
+    def hottest(self, limit):
+        """Return the limit most requested (zoom, x, y) positions, summed over all layers.
+        
+        Positions are shared across layers, so a new scene is warmed where
+        earlier scenes of the same estates were viewed.
+        """
+        self.flush()
+        totals = Counter()
+        for counts_path in self.access_dir.glob("*.counts"):
+            totals.update(self.load(counts_path.stem))
+        return [tile for tile, _ in totals.most_common(limit)]
+
+access_counter = AccessCounter()
+
+def prewarm(tile_count, layer_name=None):
+    """Render or load the tile_count most requested tile positions of every layer, or only layer_name.
+    
+    Dynamic tiles land in the renderer's cache; pre-rendered tiles are read
+    so the OS keeps them in its file cache. Positions are warmed hottest
+    first across all layers, and warming stops once the dynamic tiles
+    warmed fill the renderer's cache budget, so late tiles never evict
+    earlier ones. Pre-rendered tiles never enter that cache and do not
+    count against it.
+    """
+    positions = access_counter.hottest(tile_count)
+    layers = [layer for layer in list_layers() if layer_name is None or layer[0] == layer_name]
+    requests = [(name, extension, *position) for position in positions for name, extension in layers]
+    budget = renderer.cache.max_bytes if renderer is not None else None
+    start = time.perf_counter()
+    warmed = 0
+    cached_bytes = 0
+    for name, extension, zoom, tile_x, tile_y in requests:
+        if budget is not None and cached_bytes >= budget:
+            print(f"Prewarm stopped at the {budget / (1024 * 1024):.0f} MB cache budget")
+            break
+        try:
+            tile = load_tile(name, zoom, tile_x, tile_y, extension)
+        except Exception as e:
+            print(f"Could not prewarm {name}/{zoom}/{tile_x}/{tile_y}: {e}")
+            continue
+        if tile is not None:
+            warmed += 1
+        if renderer is not None:
+            # Only tiles the renderer cached, including blank ones, use the budget
+            cached_bytes += renderer.cache.cached_bytes((name, zoom, tile_x, tile_y))
+    print(f"Prewarmed {warmed} tiles ({len(positions)} positions x {len(layers)} layers, "
+          f"{cached_bytes / (1024 * 1024):.1f} MB cached) in {time.perf_counter() - start:.1f}s")
+
+def start_prewarm(tile_count, layer_name=None):
+    """Prewarm in a background thread. Returns False, starting nothing, if a prewarm is running."""
+    if not prewarm_lock.acquire(blocking=False):
+        return False
+    
+    def run():
+        try:
+            prewarm(tile_count, layer_name)
+        finally:
+            prewarm_lock.release()
+    
+    threading.Thread(target=run, daemon=True).start()
+    return True
+
+def tile_content_type(tile_bytes):
+    """Return the media type of PNG or WebP tile bytes."""
+    if tile_bytes[:4] == b"RIFF" and tile_bytes[8:12] == b"WEBP":
+        return 'image/webp'
+    return 'image/png'
+
+def tile_extension(layer_path):
+    """Return the tile file extension of a layer directory, MBTiles or PMTiles file."""
+    if layer_path.suffix == ".pmtiles":
+        return open_pmtiles(layer_path).extension
+    if layer_path.suffix == ".mbtiles":
+        with sqlite3.connect(f"file:{layer_path}?mode=ro", uri=True) as conn:
+            row = conn.execute("SELECT value FROM metadata WHERE name = 'format'").fetchone()
+        return row[0] if row else "png"
+    first_tile = next(layer_path.glob("*/*/*.*"), None)
+    return first_tile.suffix[1:] if first_tile else "png"
+
+class TileHTTPServer(http.server.ThreadingHTTPServer):
+    """HTTP server that handles each connection on its own thread.
+    
+    Keep-alive connections sit idle between tile requests, so a fixed pool
+    would let a few open browser tabs hold every worker.
+    """
+    
+    allow_reuse_address = True
+    daemon_threads = True
 
 class TileHandler(http.server.SimpleHTTPRequestHandler):
+    # HTTP/1.1 keeps connections open between tile requests
+    protocol_version = "HTTP/1.1"
+    timeout = KEEP_ALIVE_TIMEOUT
+    
     def __init__(self, *args, **kwargs):
         super().__init__(*args, directory=str(TILES_DIR), **kwargs)
     
+    def do_GET(self):
+        if not self.send_tile():
+            super().do_GET()
+    
+    def do_HEAD(self):
+        if not self.send_tile(head_only=True):
+            super().do_HEAD()
+    
+    def do_POST(self):
+        url = urlsplit(self.path)
+        if url.path != "/_prewarm":
+            self.send_error(404)
+            return
+        query = parse_qs(url.query)
+        try:
+            tile_count = int(query.get("tiles", [PREWARM_TILES])[0])
+        except ValueError:
+            self.send_error(400, "tiles must be an integer")
+            return
+        layer_name = query.get("layer", [None])[0]
+        if layer_name is not None and layer_name not in dict(list_layers()):
+            self.send_error(404, f"Unknown layer: {layer_name}")
+            return
+        if not start_prewarm(tile_count, layer_name):
+            self.send_error(409, "A prewarm is already running")
+            return
+        self.send_response(202)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+    
+    def send_tile(self, head_only=False):
+        """Serve a tile request with caching headers. Returns False for non-tile paths."""
+        match = TILE_PATH.match(self.path.split("?")[0])
+        if not match:
+            return False
+        
+        layer_name, extension = match.group(1), match.group(5)
+        zoom, tile_x, tile_y = (int(value) for value in match.groups()[1:4])
+        try:
+            tile = load_tile(layer_name, zoom, tile_x, tile_y, extension)
+        except Exception as e:
+            self.send_error(500, f"Could not render tile: {e}")
+            return True
+        if tile is None:
+            # Blank, ocean and off-field tiles are never written, so misses are
+            # common: answer them without closing the keep-alive connection
+            # (send_error always does) and let browsers cache them
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.send_header('Cache-Control', f'public, max-age={MISSING_TILE_MAX_AGE}')
+            self.end_headers()
+            return True
+        
+        access_counter.record(layer_name, zoom, tile_x, tile_y)
+        tile_bytes, etag, last_modified = tile
+        if self.is_not_modified(etag, last_modified):
+            self.send_response(304)
+            self.send_cache_headers(etag, last_modified)
+            self.end_headers()
+            return True
+        
+        self.send_response(200)
+        self.send_header('Content-Type', tile_content_type(tile_bytes))
+        self.send_header('Content-Length', str(len(tile_bytes)))
+        self.send_cache_headers(etag, last_modified)
+        self.end_headers()
+        if not head_only:
+            self.wfile.write(tile_bytes)
+        return True
+    
+    def is_not_modified(self, etag, last_modified):
+        """Check the request's If-None-Match / If-Modified-Since against the tile."""
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match is not None:
+            tags = [tag.strip() for tag in if_none_match.split(",")]
+            return "*" in tags or etag in tags
+        
+        if_modified_since = self.headers.get('If-Modified-Since')
+        if if_modified_since:
+            try:
+                since = parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                return False
+            return int(last_modified) <= since
+        return False
+    
+    def send_cache_headers(self, etag, last_modified):
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', formatdate(last_modified, usegmt=True))
+        self.send_header('Cache-Control', f'public, max-age={CACHE_MAX_AGE}')
+    
     def end_headers(self):
         self.send_header('Access-Control-Allow-Origin', '*')
-        self.send_header('Access-Control-Allow-Methods', 'GET')
+        self.send_header('Access-Control-Allow-Methods', 'GET, POST')
         self.send_header('Access-Control-Allow-Headers', 'Content-Type')
         super().end_headers()
 
-if __name__ == "__main__":
+def main():
+    global renderer
+    
+    parser = argparse.ArgumentParser(description='Serve XYZ tiles from the tiles directory')
+    parser.add_argument('--port', type=int, default=PORT,
+                       help=f'Port to listen on (default: {PORT})')
+    parser.add_argument('--dynamic', metavar='TIFF_DIR',
+                       help='Render tiles that were not pre-rendered on request from the GeoTIFFs in TIFF_DIR')
+    parser.add_argument('--cache-mb', type=int, default=64,
+                       help='Memory budget for dynamically rendered tiles in MB (default: 64)')
+    parser.add_argument('--spill-dir',
+                       help='Keep dynamically rendered tiles evicted from memory in this directory')
+    parser.add_argument('--encoding', default='png', choices=['png', 'png8', 'webp', 'webp-lossless'],
+                       help='Encoding of dynamically rendered tiles (default: png)')
+    parser.add_argument('--prewarm', type=int, metavar='N',
+                       help='Render or load the N most requested tile positions of every layer at startup')
+    parser.add_argument('--prewarm-layer', metavar='LAYER',
+                       help='Only prewarm this layer, e.g. a newly ingested scene')
+    args = parser.parse_args()
+    
+    if args.dynamic:
+        # Rendering needs rasterio, so the tiler is only imported in dynamic mode
+        from create_tile_server import DynamicTileRenderer, TileCache
+        cache = TileCache(args.cache_mb * 1024 * 1024, args.spill_dir)
+        renderer = DynamicTileRenderer(args.dynamic, cache, tile_encoding=args.encoding)
+    
+    TILES_DIR.mkdir(exist_ok=True)
     os.chdir(TILES_DIR)
-    with socketserver.TCPServer(("", PORT), TileHandler) as httpd:
-        print(f"Serving tiles at http://localhost:{PORT}")
+    with TileHTTPServer(("", args.port), TileHandler) as httpd:
+        print(f"Serving tiles at http://localhost:{args.port}")
         print(f"Tiles directory: {TILES_DIR}")
         print("Available layers:")
-        for layer_dir in TILES_DIR.iterdir():
-            if layer_dir.is_dir():
-                print(f"  - {layer_dir.name}")
-                print(f"    URL: http://localhost:{PORT}/{layer_dir.name}/{{z}}/{{x}}/{{y}}.png")
+        for layer_name, extension in list_layers():
+            print(f"  - {layer_name}")
+            print(f"    URL: http://localhost:{args.port}/{layer_name}/{{z}}/{{x}}/{{y}}.{extension}")
+        if renderer is not None:
+            print(f"Rendering missing tiles on demand from {renderer.tiff_dir}")
+        if args.prewarm:
+            start_prewarm(args.prewarm, args.prewarm_layer)
+        access_counter.run_flusher()
         print("\\nPress Ctrl+C to stop the server")
-        httpd.serve_forever()
+        try:
+            httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            access_counter.flush()
+
+if __name__ == "__main__":
+    main()
 '''
     
     with open("tile_server.py", "w") as f:
@@ -205,6 +2028,36 @@ if __name__ == "__main__":
 def main():
     """Main function to create tiles from all GeoTIFF files."""
     
+    parser = argparse.ArgumentParser(description='Convert GeoTIFF files to XYZ web map tiles')
+    parser.add_argument('--workers', type=int, default=1,
+                       help='Number of worker processes per layer (default: 1, serial)')
+    parser.add_argument('--pyramid', action='store_true',
+                       help='Render only the max zoom from the GeoTIFF and build lower zooms from child tiles')
+    parser.add_argument('--build-overviews', action='store_true',
+                       help='Build internal overviews for input GeoTIFFs that have none')
+    parser.add_argument('--metatile', dest='metatile_size', type=int, default=1,
+                       help='Read and normalize NxN blocks of tiles in one call (default: 1, per tile)')
+    parser.add_argument('--palette', choices=PALETTES,
+                       help='Colour palette for all layers (default: chosen from each layer type)')
+    parser.add_argument('--format', dest='output_format', choices=['xyz', 'mbtiles', 'pmtiles'],
+                       default='xyz',
+                       help='Tile output: xyz directory tree, or one MBTiles or PMTiles file per layer (default: xyz)')
+    parser.add_argument('--encoding', dest='tile_encoding', choices=TileEncoder.FORMATS, default='png',
+                       help='Tile image encoding (default: png)')
+    parser.add_argument('--encode-level', type=int,
+                       help='PNG compression level (0-9) or WebP quality (0-100)')
+    parser.add_argument('--fields', dest='fields_path',
+                       help='Polygon GeoJSON (e.g. estate_fields.geojson); only tiles over these polygons are rendered')
+    parser.add_argument('--field-buffer', type=int, default=0,
+                       help='Also render tiles within this many tiles of a field (default: 0)')
+    parser.add_argument('--bands', type=parse_bands,
+                       help='Render these comma-separated band indexes (e.g. 1,2,3) as true-colour RGB '
+                            '(default: 1,2,3 for composite layers such as Agriculture)')
+    parser.add_argument('--compare-encodings', type=int, metavar='ZOOM',
+                       help='Report bytes and encode time per tile for each encoding at ZOOM, without tiling')
+    
+    args = parser.parse_args()
+    
     print("GeoTIFF to Web Tiles Converter")
     print("=" * 50)
     
@@ -216,24 +2069,46 @@ def main():
         print(f"Directory not found: {tiff_dir}")
         return
     
-    tiff_files = list(tiff_dir.glob("*.tiff")) + list(tiff_dir.glob("*.tif"))
+    # Optimized copies from optimize_geotiffs.py are used where available
+    tiff_files = find_tiff_files(tiff_dir)
     
     if not tiff_files:
         print(f"No TIFF files found in {tiff_dir}")
         return
     
+    if args.compare_encodings is not None:
+        for tiff_file in tiff_files:
+            compare_tile_encodings(tiff_file, args.compare_encodings, palette=args.palette,
+                                   bands=args.bands)
+        return
+    
     # Create output directory
     tiles_dir = current_dir / "tiles"
     tiles_dir.mkdir(exist_ok=True)
     
     print(f"Creating tiles for {len(tiff_files)} files...")
     print(f"Output directory: {tiles_dir}")
+    if args.workers > 1:
+        print(f"Workers: {args.workers}")
     print()
     
     # Process each TIFF file
-    for tiff_file in sorted(tiff_files):
+    for tiff_file in tiff_files:
         try:
-            create_tiles_for_geotiff(tiff_file, tiles_dir, min_zoom=12, max_zoom=16)
+            if args.build_overviews:
+                factors = ensure_overviews(tiff_file)
+                if factors:
+                    print(f"Built overviews {factors} for {tiff_file.name}")
+            create_tiles_for_geotiff(tiff_file, tiles_dir, min_zoom=12, max_zoom=16,
+                                     workers=args.workers, pyramid=args.pyramid,
+                                     output_format=args.output_format,
+                                     metatile_size=args.metatile_size,
+                                     palette=args.palette,
+                                     tile_encoding=args.tile_encoding,
+                                     encode_level=args.encode_level,
+                                     fields_path=args.fields_path,
+                                     field_buffer=args.field_buffer,
+                                     bands=args.bands)
         except Exception as e:
             print(f"❌ Error processing {tiff_file.name}: {e}")
     
@@ -247,6 +2122,8 @@ def main():
     print("2. Add layers to your Leaflet app using URLs like:")
     print("   http://localhost:8000/{layer_name}/{z}/{x}/{y}.png")
     print("3. Available layers will be shown when you start the server")
+    print("4. To render new scenes on request without tiling them first:")
+    print(f'   python tile_server.py --dynamic "{tiff_dir.name}"')
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+"""
+Script to precompute the display stretch statistics of each GeoTIFF layer.
+
+Layers without a fixed value range are stretched between their 2nd and
+98th percentiles. Computing those per tile is slow and gives every tile its
+own stretch, so this pass computes them once per layer from an evenly
+decimated read of an overview (or of the full raster when the file has no
+overviews) and caches them in
+a "<file>.stats.json" sidecar. The tile generator, the tile server and the
+PNG overlay generator then all apply the same linear stretch.
+"""
+
+import os
+import json
+import math
+import argparse
+from pathlib import Path
+
+import numpy as np
+
+from colormap import VALUE_RANGES, band_value_range
+from optimize_geotiffs import find_tiff_files
+
+STATS_SUFFIX = ".stats.json"
+
+# Percentiles recorded for each band; the first and last form the stretch
+STATS_PERCENTILES = (2, 98)
+
+# Bumped whenever the statistics change meaning; older sidecars are recomputed
+STATS_VERSION = 3
+
+# Roughly how many pixels are sampled per layer. The smallest overview with
+# at least this many pixels, or the full-resolution raster without one, is
+# read decimated to about this many pixels spread evenly over its whole
+# extent. The sample is held in memory, so this bounds what computing the
+# statistics costs.
+STATS_SAMPLE_PIXELS = 1024 * 1024
+
+def stats_path(tiff_file):
+    """Return where the statistics sidecar of a TIFF is written."""
+    tiff_file = Path(tiff_file)
+    return tiff_file.with_name(tiff_file.name + STATS_SUFFIX)
+
+def sample_shape(tiff_file):
+    """Return (overview_level, (rows, cols)): the level the statistics are sampled from and its read shape.
+    
+    overview_level is None when the full-resolution raster is sampled.
+    Even the chosen overview can be far larger than the sample (e.g. a lone
+    1/2 one), so its rows and columns are scaled down alike to keep about
+    STATS_SAMPLE_PIXELS pixels.
+    """
+    import rasterio
+    
+    with rasterio.open(tiff_file) as src:
+        overview_level = None
+        width, height = src.width, src.height
+        for level, factor in enumerate(src.overviews(1)):
+            if (src.width // factor) * (src.height // factor) >= STATS_SAMPLE_PIXELS:
+                overview_level = level
+                width, height = src.width // factor, src.height // factor
+    
+    scale = min(1.0, math.sqrt(STATS_SAMPLE_PIXELS / (width * height)))
+    return overview_level, (max(1, round(height * scale)), max(1, round(width * scale)))
+
+def read_valid_values(src, shape):
+    """Read a dataset decimated to shape and return a list holding each band's valid pixel values."""
+    from rasterio.enums import Resampling
+    
+    data = src.read(out_shape=(src.count, *shape), resampling=Resampling.nearest)
+    valid = src.dataset_mask(out_shape=shape) > 0
+    if np.issubdtype(data.dtype, np.floating):
+        valid &= ~np.isnan(data).any(axis=0)
+    if src.nodata is not None and not np.isnan(src.nodata):
+        valid &= (data != src.nodata).all(axis=0)
+    return [band[valid] for band in data]
+
+def compute_layer_stats(tiff_file, percentiles=STATS_PERCENTILES):
+    """Compute the minimum, maximum and percentiles of every band of a TIFF.
+    
+    The percentiles are exact over the sample (as np.percentile), so a few
+    extreme pixels cannot stretch the whole layer towards them.
+    """
+    import rasterio
+    
+    overview_level, shape = sample_shape(tiff_file)
+    
+    with rasterio.open(tiff_file, overview_level=overview_level) as src:
+        samples = read_valid_values(src, shape)
+    
+    bands = []
+    for band_values in samples:
+        if not band_values.size:
+            bands.append(None)
+            continue
+        bands.append({
+            'min': float(band_values.min()),
+            'max': float(band_values.max()),
+            'percentiles': dict(zip(map(str, percentiles),
+                                    map(float, np.percentile(band_values, percentiles)))),
+        })
+    
+    return {
+        'version': STATS_VERSION,
+        'overview_level': overview_level,
+        'sample_pixels': samples[0].size if samples else 0,
+        'bands': bands,
+    }
+
+def load_layer_stats(tiff_file, force=False):
+    """Return a TIFF's statistics, computing and caching them unless the sidecar is up to date."""
+    tiff_file = Path(tiff_file)
+    sidecar = stats_path(tiff_file)
+    
+    if not force and sidecar.exists() and sidecar.stat().st_mtime >= tiff_file.stat().st_mtime:
+        with open(sidecar) as f:
+            stats = json.load(f)
+        if stats.get('version') == STATS_VERSION:
+            return stats
+    
+    stats = compute_layer_stats(tiff_file)
+    
+    # Write to a temporary name so concurrent readers never see a partial file
+    temp_path = sidecar.with_name(f".{sidecar.name}.tmp")
+    try:
+        with open(temp_path, 'w') as f:
+            json.dump(stats, f, indent=2)
+        os.replace(temp_path, sidecar)
+    except OSError as e:
+        print(f"⚠️  Could not cache statistics for {tiff_file.name}: {e}")
+    return stats
+
+def layer_value_range(tiff_file, layer_type, band=1):
+    """Return the (min, max) display stretch of a layer band.
+    
+    Layer types with a fixed value range use it; others use the band's
+    cached 2nd and 98th percentiles, or None if the band has no valid data.
+    """
+    if layer_type in VALUE_RANGES:
+        return VALUE_RANGES[layer_type]
+    
+    band_stats = load_layer_stats(tiff_file)['bands'][band - 1]
+    if band_stats is None:
+        return None
+    percentiles = band_stats['percentiles']
+    return (percentiles[str(STATS_PERCENTILES[0])], percentiles[str(STATS_PERCENTILES[-1])])
+
+def band_value_ranges(tiff_file, bands, dtype):
+    """Return the (min, max) display stretch of each of several bands, e.g. of an RGB composite.
+    
+    Each band uses its cached 2nd and 98th percentiles; a band without
+    statistics falls back to the full range of dtype (see
+    colormap.band_value_range).
+    """
+    bands_stats = load_layer_stats(tiff_file)['bands']
+    ranges = []
+    for band in bands:
+        band_stats = bands_stats[band - 1]
+        if band_stats is None:
+            ranges.append(band_value_range(dtype))
+            continue
+        percentiles = band_stats['percentiles']
+        ranges.append((percentiles[str(STATS_PERCENTILES[0])], percentiles[str(STATS_PERCENTILES[-1])]))
+    return ranges
+
+def main():
+    """Main function to precompute statistics for all extracted GeoTIFF files."""
+    
+    parser = argparse.ArgumentParser(description='Precompute per-layer stretch statistics for GeoTIFF files')
+    parser.add_argument('--force', action='store_true',
+                       help='Recompute statistics even if the cached sidecars are up to date')
+    
+    args = parser.parse_args()
+    
+    print("GeoTIFF Layer Statistics")
+    print("=" * 50)
+    
+    current_dir = Path.cwd()
+    tiff_dir = current_dir / "Browser_images (2)_clean"
+    
+    if not tiff_dir.exists():
+        print(f"Directory not found: {tiff_dir}")
+        print("Please run the rename script first to extract the TIFF files.")
+        return
+    
+    for tiff_file in find_tiff_files(tiff_dir):
+        try:
+            stats = load_layer_stats(tiff_file, force=args.force)
+        except Exception as e:
+            print(f"❌ Error computing statistics for {tiff_file.name}: {e}")
+            continue
+        
+        source = (f"overview {stats['overview_level']}" if stats['overview_level'] is not None
+                  else "full resolution")
+        print(f"✅ {tiff_file.name} ({stats['sample_pixels']} pixels, {source})")
+        for band, band_stats in enumerate(stats['bands'], start=1):
+            if band_stats is None:
+                print(f"    Band {band}: no valid data")
+                continue
+            percentiles = ", ".join(f"p{p}={v:.4f}" for p, v in band_stats['percentiles'].items())
+            print(f"    Band {band}: min={band_stats['min']:.4f}, max={band_stats['max']:.4f}, {percentiles}")
+
+if __name__ == "__main__":
+    main()
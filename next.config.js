@@ -44,6 +44,21 @@ const nextConfig = {
   // Improve TTFB with compression
   compress: true,
 
+  // Sentinel overlay PNGs are named after their content hash, so they never change;
+  // the manifest listing them must be revalidated to pick up new hashes
+  async headers() {
+    return [
+      {
+        source: '/sentinel_overlays/:file(.+\\.[0-9a-f]{12}\\.png)',
+        headers: [{ key: 'Cache-Control', value: 'public, max-age=31536000, immutable' }],
+      },
+      {
+        source: '/sentinel_overlays/manifest.json',
+        headers: [{ key: 'Cache-Control', value: 'no-cache' }],
+      },
+    ]
+  },
+
   // Optimize images
   images: {
     formats: ['image/webp', 'image/avif'],
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+"""
+Script to convert the extracted Sentinel GeoTIFFs to Cloud Optimized GeoTIFFs.
+
+The TIFFs extracted by rename_tiff_files.py are strip-organized and
+uncompressed, so every windowed read decodes whole image strips. This
+stage writes an internally tiled, DEFLATE-compressed copy with overviews
+of each file into an "optimized" subdirectory. find_tiff_files() hands
+those copies to create_tile_server.py, simple_raster_overlay.py and
+analyze_tiff_files.py in place of the originals.
+"""
+
+import os
+import argparse
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+
+# Subdirectory of the TIFF directory that holds the optimized copies
+OPTIMIZED_DIR_NAME = "optimized"
+
+# Internal tile size of the optimized copies; rasters larger than one
+# tile also get overviews
+BLOCK_SIZE = 512
+
+# GDAL COG driver creation options
+COG_OPTIONS = {
+    "BLOCKSIZE": BLOCK_SIZE,
+    "COMPRESS": "DEFLATE",
+    "LEVEL": 6,
+    "PREDICTOR": "YES",  # Floating-point predictor for float bands
+    "OVERVIEW_RESAMPLING": "AVERAGE",
+    "BIGTIFF": "IF_SAFER",
+}
+
+def optimized_path(tiff_file):
+    """Return where the optimized copy of a TIFF is written."""
+    tiff_file = Path(tiff_file)
+    return tiff_file.parent / OPTIMIZED_DIR_NAME / tiff_file.name
+
+def is_up_to_date(tiff_file):
+    """Check whether a TIFF has an optimized copy at least as new as itself."""
+    output_path = optimized_path(tiff_file)
+    return output_path.exists() and output_path.stat().st_mtime >= Path(tiff_file).stat().st_mtime
+
+def find_tiff_files(tiff_dir):
+    """Return the sorted TIFFs in tiff_dir, each replaced by its optimized copy if that is up to date."""
+    tiff_dir = Path(tiff_dir)
+    tiff_files = sorted(list(tiff_dir.glob("*.tiff")) + list(tiff_dir.glob("*.tif")))
+    return [optimized_path(tiff_file) if is_up_to_date(tiff_file) else tiff_file
+            for tiff_file in tiff_files]
+
+def is_cloud_optimized(tiff_file):
+    """Check whether a GeoTIFF is internally tiled, compressed, and has overviews if it needs them."""
+    import rasterio
+    
+    with rasterio.open(tiff_file) as src:
+        tiled = src.profile.get('tiled', False)
+        compressed = src.compression is not None
+        has_overviews = bool(src.overviews(1)) or max(src.width, src.height) <= BLOCK_SIZE
+    return tiled and compressed and has_overviews
+
+def optimize_geotiff(tiff_file, force=False):
+    """Write the Cloud Optimized GeoTIFF copy of a TIFF and return a status line.
+    
+    Files whose copy is up to date, or that are already tiled, compressed
+    and overviewed, are skipped unless force is set.
+    """
+    import rasterio
+    import rasterio.shutil
+    
+    tiff_file = Path(tiff_file)
+    output_path = optimized_path(tiff_file)
+    
+    if not force:
+        if is_up_to_date(tiff_file):
+            return f"Up to date: {tiff_file.name}"
+        if is_cloud_optimized(tiff_file):
+            return f"Already optimized: {tiff_file.name}"
+    
+    # Write to a temporary name so downstream scripts never pick up a partial file
+    output_path.parent.mkdir(exist_ok=True)
+    temp_path = output_path.with_name(f".{output_path.name}.tmp")
+    with rasterio.open(tiff_file) as src:
+        rasterio.shutil.copy(src, temp_path, driver="COG", **COG_OPTIONS)
+    os.replace(temp_path, output_path)
+    
+    original_mb = tiff_file.stat().st_size / 1024 / 1024
+    optimized_mb = output_path.stat().st_size / 1024 / 1024
+    return f"Optimized: {tiff_file.name} ({original_mb:.1f} MB -> {optimized_mb:.1f} MB)"
+
+def optimize_geotiffs(tiff_dir, workers=None, force=False):
+    """Optimize every TIFF in tiff_dir in parallel, one file per worker process.
+    
+    Returns the number of files that failed.
+    """
+    tiff_dir = Path(tiff_dir)
+    tiff_files = sorted(list(tiff_dir.glob("*.tiff")) + list(tiff_dir.glob("*.tif")))
+    failures = 0
+    
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(optimize_geotiff, tiff_file, force) for tiff_file in tiff_files]
+        for tiff_file, future in zip(tiff_files, futures):
+            try:
+                print(f"✅ {future.result()}")
+            except Exception as e:
+                print(f"❌ Error optimizing {tiff_file.name}: {e}")
+                failures += 1
+    
+    return failures
+
+def main():
+    """Main function to optimize all extracted GeoTIFF files."""
+    
+    parser = argparse.ArgumentParser(description='Convert GeoTIFF files to Cloud Optimized GeoTIFFs')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                       help='Number of files converted in parallel (default: number of CPUs)')
+    parser.add_argument('--force', action='store_true',
+                       help='Rewrite optimized copies even if they are up to date')
+    
+    args = parser.parse_args()
+    
+    print("GeoTIFF to Cloud Optimized GeoTIFF Converter")
+    print("=" * 50)
+    
+    current_dir = Path.cwd()
+    tiff_dir = current_dir / "Browser_images (2)_clean"
+    
+    if not tiff_dir.exists():
+        print(f"Directory not found: {tiff_dir}")
+        print("Please run the rename script first to extract the TIFF files.")
+        return
+    
+    print(f"Output directory: {tiff_dir / OPTIMIZED_DIR_NAME}")
+    print()
+    
+    failures = optimize_geotiffs(tiff_dir, workers=args.workers, force=args.force)
+    
+    print("\n" + "=" * 50)
+    if failures:
+        print(f"❌ {failures} files could not be optimized; their originals will be used")
+    print("create_tile_server.py, simple_raster_overlay.py and analyze_tiff_files.py")
+    print("now read the optimized copies automatically.")
+
+if __name__ == "__main__":
+    main()
@@ -236,6 +236,7 @@ def main():
 
     print(f"\nProcessing ZIP and extracting with clean filenames...")
     process_zip_with_renamed_files(zip_file_path)
+    print("\nNext: run optimize_geotiffs.py to write tiled, compressed copies for faster reads")
 
 if __name__ == "__main__":
     main()
@@ -2,60 +2,192 @@
 """
 Simple approach: Convert GeoTIFF to PNG with world file for direct Leaflet overlay.
 This is simpler than tiling but less performant for large areas.
+
+Overlays are streamed: the raster is read in block-aligned row strips, and
+each strip is colour-mapped and passed straight to a row-oriented PNG
+encoder, so peak memory depends on the strip height rather than the image
+size. The same pass also writes 1/2, 1/4 and 1/8 resolution variants of
+each overlay, listed in a manifest.json so the map can load the smallest
+variant that fits its current zoom.
+
+Overlay file names carry a hash of their content, so their URLs never
+change meaning and can be cached forever; only the small manifest, which
+the app fetches when an overlay is first shown, has to be revalidated. An
+overlay whose content has not changed keeps its file untouched.
 """
 
+import os
+import re
+import json
+import math
+import hashlib
+import zlib
+import struct
+import argparse
+import contextlib
 import rasterio
 import numpy as np
-from PIL import Image
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from rasterio.windows import Window
+from colormap import PALETTES, apply_colormap, normalize_values, palette_for_layer
+from layer_stats import layer_value_range
+from optimize_geotiffs import find_tiff_files
+
+# Target rows per strip; strips are rounded to whole blocks of the source
+STRIP_ROWS = 512
+
+# Downsampling factors of the reduced-resolution variants written next to each overlay
+VARIANT_FACTORS = (2, 4, 8)
+
+# URL under which the web app serves public/sentinel_overlays
+OVERLAY_URL_PREFIX = "/sentinel_overlays/"
+
+# Hex digits of the content hash kept in overlay file names
+CONTENT_HASH_LENGTH = 12
+
+# "<layer>.<hash>.png" or "<layer>.1-<factor>.<hash>.png"
+HASHED_FILENAME = re.compile(rf"^(?P<layer>.+?)(?:\.1-\d+)?\.[0-9a-f]{{{CONTENT_HASH_LENGTH}}}\.png$")
 
-def normalize_for_display(data, layer_type):
-    """Normalize data for RGB display."""
+class PNGStreamWriter:
+    """Writes an 8-bit RGB or RGBA PNG one strip of rows at a time.
     
-    if layer_type == "vegetation":  # NDVI, EVI, SAVI, Agriculture
-        # Vegetation indices: create green colormap
-        # Clip to reasonable range
-        clipped = np.clip(data, -0.2, 1.0)
-        normalized = ((clipped + 0.2) / 1.2 * 255).astype(np.uint8)
-        
-        # Create RGB (green-based)
-        rgb = np.zeros((*data.shape, 3), dtype=np.uint8)
-        rgb[:, :, 1] = normalized  # Green channel
-        rgb[:, :, 0] = normalized // 3  # Some red for variation
-        
-    elif layer_type == "moisture":  # Moisture indices
-        # Moisture: create blue colormap
-        clipped = np.clip(data, 0, 1)
-        normalized = (clipped * 255).astype(np.uint8)
-        
-        rgb = np.zeros((*data.shape, 3), dtype=np.uint8)
-        rgb[:, :, 2] = normalized  # Blue channel
-        rgb[:, :, 0] = normalized // 4  # Slight red tint
-        
-    elif layer_type == "soil":  # Barren soil
-        # Soil: create brown/orange colormap
-        clipped = np.clip(data, -6, 5)
-        normalized = ((clipped + 6) / 11 * 255).astype(np.uint8)
-        
-        rgb = np.zeros((*data.shape, 3), dtype=np.uint8)
-        rgb[:, :, 0] = normalized  # Red channel
-        rgb[:, :, 1] = normalized // 2  # Some green for brown
-        
-    else:
-        # Default grayscale
-        min_val, max_val = np.nanpercentile(data, [2, 98])
-        clipped = np.clip(data, min_val, max_val)
-        if max_val > min_val:
-            normalized = ((clipped - min_val) / (max_val - min_val) * 255).astype(np.uint8)
+    Rows are Sub-filtered and fed through a single zlib stream, and nothing
+    larger than a strip is ever held in memory. The compressed stream is cut
+    into IDAT chunks of IDAT_CHUNK_BYTES, so the file bytes, and the SHA-256
+    updated as they are written, depend only on the pixels and not on how
+    they were split into strips. Used as a context manager, a file left incomplete by
+    an exception is deleted.
+    """
+    
+    COLOR_TYPES = {"RGB": 2, "RGBA": 6}
+    IDAT_CHUNK_BYTES = 64 * 1024
+    
+    def __init__(self, path, width, height, mode="RGBA", compress_level=6):
+        self.width = width
+        self.height = height
+        self.channels = len(mode)
+        self.rows_written = 0
+        self.sha256 = hashlib.sha256()
+        self._compressor = zlib.compressobj(compress_level)
+        self._pending = bytearray()
+        self._path = Path(path)
+        self._file = open(path, "wb")
+        self._write(b"\x89PNG\r\n\x1a\n")
+        self._write_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8,
+                                               self.COLOR_TYPES[mode], 0, 0, 0))
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
         else:
-            normalized = np.zeros_like(clipped, dtype=np.uint8)
+            self._file.close()
+            self._path.unlink(missing_ok=True)
+    
+    def _write(self, data):
+        self._file.write(data)
+        self.sha256.update(data)
+    
+    def _write_chunk(self, chunk_type, data):
+        self._write(struct.pack(">I", len(data)) + chunk_type + data +
+                    struct.pack(">I", zlib.crc32(chunk_type + data)))
+    
+    def write_rows(self, rows):
+        """Append a (rows, width, channels) uint8 array below the rows written so far."""
+        if rows.shape[1:] != (self.width, self.channels):
+            raise ValueError(f"Expected rows of shape (n, {self.width}, {self.channels}), got {rows.shape}")
+        if self.rows_written + len(rows) > self.height:
+            raise ValueError(f"More than {self.height} rows written")
         
-        rgb = np.stack([normalized, normalized, normalized], axis=2)
+        # Filter type 1 (Sub): each byte minus the same channel of the pixel to its left
+        pixels = rows.reshape(len(rows), -1)
+        scanlines = np.empty((len(rows), pixels.shape[1] + 1), dtype=np.uint8)
+        scanlines[:, 0] = 1
+        scanlines[:, 1:] = pixels
+        scanlines[:, 1 + self.channels:] -= pixels[:, :-self.channels]
+        
+        self._pending += self._compressor.compress(scanlines.tobytes())
+        while len(self._pending) >= self.IDAT_CHUNK_BYTES:
+            self._write_chunk(b"IDAT", bytes(self._pending[:self.IDAT_CHUNK_BYTES]))
+            del self._pending[:self.IDAT_CHUNK_BYTES]
+        self.rows_written += len(rows)
+    
+    def close(self):
+        """Finish the zlib stream and the file."""
+        if self.rows_written != self.height:
+            self._file.close()
+            raise ValueError(f"Only {self.rows_written} of {self.height} rows written")
+        self._pending += self._compressor.flush()
+        self._write_chunk(b"IDAT", bytes(self._pending))
+        self._write_chunk(b"IEND", b"")
+        self._file.close()
+
+def strip_windows(src, strip_rows=STRIP_ROWS, align=1):
+    """Yield full-width row windows of about strip_rows rows.
     
-    return rgb
+    Strips are aligned to the source's blocks and to multiples of align rows.
+    """
+    block_rows = src.block_shapes[0][0]
+    step = block_rows * align // math.gcd(block_rows, align)
+    rows = max(step, strip_rows // step * step)
+    for row_off in range(0, src.height, rows):
+        yield Window(0, row_off, src.width, min(rows, src.height - row_off))
 
-def create_png_overlay(geotiff_path, output_dir):
-    """Convert GeoTIFF to PNG with transparency for Leaflet overlay."""
+def variant_filename(layer_name, factor, content_hash=None):
+    """Return the PNG file name of a layer's 1/factor resolution variant.
+    
+    With a content_hash, its first CONTENT_HASH_LENGTH digits are part of the name.
+    """
+    stem = layer_name if factor == 1 else f"{layer_name}.1-{factor}"
+    if content_hash is not None:
+        stem += f".{content_hash[:CONTENT_HASH_LENGTH]}"
+    return f"{stem}.png"
+
+def downsample_strip(data, valid, factor):
+    """Average factor x factor pixel blocks of a strip, ignoring invalid pixels.
+    
+    Returns (data, valid) at 1/factor resolution; a block is valid if any
+    of its pixels is. Partial blocks at the right and bottom edges are
+    averaged over the pixels they have.
+    """
+    rows, cols = data.shape
+    out_rows, out_cols = -(-rows // factor), -(-cols // factor)
+    
+    values = np.zeros((out_rows * factor, out_cols * factor), dtype=np.float64)
+    values[:rows, :cols] = np.where(valid, data, 0)
+    counts = np.zeros(values.shape, dtype=np.int32)
+    counts[:rows, :cols] = valid
+    
+    sums = values.reshape(out_rows, factor, out_cols, factor).sum(axis=(1, 3))
+    counts = counts.reshape(out_rows, factor, out_cols, factor).sum(axis=(1, 3))
+    means = np.divide(sums, counts, out=np.zeros(sums.shape), where=counts > 0)
+    return means, counts > 0
+
+def colorize_strip(data, valid, layer_type, value_range, palette):
+    """Return the RGBA rows of a strip, transparent wherever valid is False."""
+    normalized = normalize_values(data, layer_type, value_range)
+    rgba_data = apply_colormap(normalized, palette, 4)
+    rgba_data[~valid, 3] = 0
+    return rgba_data
+
+def create_png_overlay(geotiff_path, output_dir, palette=None, strip_rows=STRIP_ROWS,
+                       variant_factors=VARIANT_FACTORS):
+    """Convert GeoTIFF to PNG with transparency for Leaflet overlay.
+    
+    palette names a colormap palette; by default the layer type picks one.
+    The PNG is written strip by strip, strip_rows rows (rounded to whole
+    source blocks) at a time. Each factor in variant_factors adds a 1/factor
+    resolution variant, averaged from the same strips.
+    
+    Each PNG is named after its content hash. If a file of that name already
+    exists, the overlay is unchanged and the file is left as it is.
+    
+    Returns the layer's bounds and type, with a 'variants' list giving each
+    PNG's url, width, height, bytes and sha256, full resolution first.
+    """
     
     geotiff_path = Path(geotiff_path)
     layer_name = geotiff_path.stem
@@ -72,100 +204,162 @@ def create_png_overlay(geotiff_path, output_dir):
     
     print(f"Converting {layer_name} ({layer_type})...")
     
-    with rasterio.open(geotiff_path) as src:
-        # Read the first band
-        data = src.read(1)
-        
-        # Create RGB image
-        rgb_data = normalize_for_display(data, layer_type)
-        
-        # Create alpha channel (transparency for no-data areas)
-        alpha = np.where(np.isnan(data), 0, 255).astype(np.uint8)
-        
-        # Combine RGB + Alpha
-        rgba_data = np.dstack([rgb_data, alpha])
+    # The whole layer shares one stretch, the same cached one as its tiles
+    value_range = layer_value_range(geotiff_path, layer_type)
+    palette = palette or palette_for_layer(layer_type)
+    factors = (1, *variant_factors)
+    output_dir = Path(output_dir)
+    
+    # Write to temporary names so a failed conversion leaves no partial PNGs;
+    # the final names are only known once the content hashes are
+    temp_paths = [output_dir / f".{variant_filename(layer_name, factor)}.tmp" for factor in factors]
+    with rasterio.open(geotiff_path) as src, contextlib.ExitStack() as stack:
+        writers = [
+            stack.enter_context(PNGStreamWriter(temp_path, -(-src.width // factor),
+                                                -(-src.height // factor), "RGBA"))
+            for temp_path, factor in zip(temp_paths, factors)
+        ]
         
-        # Create PIL image
-        img = Image.fromarray(rgba_data, mode='RGBA')
+        # Strips hold whole blocks of every variant
+        for window in strip_windows(src, strip_rows, align=max(factors)):
+            # Read the first band
+            data = src.read(1, window=window)
+            
+            # No-data areas (NaN, nodata value or internal mask) are transparent
+            valid = src.read_masks(1, window=window) > 0
+            if np.issubdtype(data.dtype, np.floating):
+                valid &= ~np.isnan(data)
+            
+            for writer, factor in zip(writers, factors):
+                if factor == 1:
+                    writer.write_rows(colorize_strip(data, valid, layer_type, value_range, palette))
+                else:
+                    variant_data, variant_valid = downsample_strip(data, valid, factor)
+                    writer.write_rows(colorize_strip(variant_data, variant_valid, layer_type,
+                                                     value_range, palette))
         
-        # Save PNG
-        output_path = Path(output_dir) / f"{layer_name}.png"
-        img.save(output_path, 'PNG')
+        stack.close()
+        output_paths = []
+        unchanged = 0
+        for temp_path, writer, factor in zip(temp_paths, writers, factors):
+            output_path = output_dir / variant_filename(layer_name, factor,
+                                                        writer.sha256.hexdigest())
+            if output_path.exists():
+                # Same hash, same content: keep the existing file and its timestamps
+                temp_path.unlink()
+                unchanged += 1
+            else:
+                os.replace(temp_path, output_path)
+            output_paths.append(output_path)
         
         # Create bounds info for Leaflet
         bounds = src.bounds
         bounds_info = {
-            'filename': f"{layer_name}.png",
+            'filename': output_paths[0].name,
             'bounds': [[bounds.bottom, bounds.left], [bounds.top, bounds.right]],
             'layer_name': layer_name,
-            'layer_type': layer_type
+            'layer_type': layer_type,
+            'variants': [
+                {
+                    'url': OVERLAY_URL_PREFIX + output_path.name,
+                    'width': writer.width,
+                    'height': writer.height,
+                    'bytes': output_path.stat().st_size,
+                    'sha256': writer.sha256.hexdigest(),
+                }
+                for writer, output_path in zip(writers, output_paths)
+            ],
         }
         
-        print(f"  ✅ Created {output_path}")
+        if unchanged == len(output_paths):
+            print(f"  ✅ Unchanged: {output_paths[0].name} and its reduced variants")
+        else:
+            print(f"  ✅ Created {output_paths[0]} and {len(variant_factors)} reduced variants")
         print(f"  📍 Bounds: {bounds}")
         
         return bounds_info
 
-def create_leaflet_integration_code(layers_info):
-    """Generate JavaScript code for adding layers to Leaflet map."""
-    
-    js_code = '''
-// Add Sentinel-2 raster overlays to your Leaflet map
-// Place this code in your MapComponent.tsx or create a new component
-
-const sentinelLayers = {
-'''
-    
-    for layer_info in layers_info:
-        layer_id = layer_info['layer_name'].replace('-', '_').replace(' ', '_')
-        js_code += f'''
-  {layer_id}: {{
-    name: "{layer_info['layer_name']}",
-    type: "{layer_info['layer_type']}",
-    url: "/sentinel_overlays/{layer_info['filename']}",
-    bounds: {layer_info['bounds']},
-    opacity: 0.7
-  }},'''
-    
-    js_code += '''
-}
-
-// Function to add a Sentinel layer to the map
-function addSentinelLayer(map, layerId) {
-  const layerInfo = sentinelLayers[layerId]
-  if (!layerInfo) return null
-  
-  const imageOverlay = L.imageOverlay(layerInfo.url, layerInfo.bounds, {
-    opacity: layerInfo.opacity,
-    interactive: false
-  })
-  
-  imageOverlay.addTo(map)
-  return imageOverlay
-}
-
-// Example usage in your MapComponent:
-// const ndviLayer = addSentinelLayer(mapInstance, 'NDVI')
-
-// Layer control example:
-const overlayMaps = {}
-Object.keys(sentinelLayers).forEach(layerId => {
-  const layerInfo = sentinelLayers[layerId]
-  overlayMaps[layerInfo.name] = L.imageOverlay(layerInfo.url, layerInfo.bounds, {
-    opacity: layerInfo.opacity,
-    interactive: false
-  })
-})
-
-// Add to layer control
-L.control.layers(null, overlayMaps).addTo(map)
-'''
-    
-    return js_code
+def create_png_overlays(tiff_files, output_dir, palette=None, strip_rows=STRIP_ROWS, workers=1):
+    """Convert TIFFs to PNG overlays, one file per worker process when workers > 1.
+    
+    Returns (layers_info, failures): the bounds info of the converted files
+    in the order of tiff_files, and the number of files that failed. A
+    failed file is reported and skipped without stopping the batch.
+    """
+    layers_info = []
+    failures = 0
+    
+    if workers > 1:
+        executor = ProcessPoolExecutor(max_workers=workers)
+        futures = [executor.submit(create_png_overlay, tiff_file, output_dir, palette, strip_rows)
+                   for tiff_file in tiff_files]
+    else:
+        executor = None
+        futures = [None] * len(tiff_files)
+    
+    try:
+        # Results are collected in submission order, whatever order they finish in
+        for tiff_file, future in zip(tiff_files, futures):
+            try:
+                if future is None:
+                    layer_info = create_png_overlay(tiff_file, output_dir, palette, strip_rows)
+                else:
+                    layer_info = future.result()
+                layers_info.append(layer_info)
+            except Exception as e:
+                print(f"❌ Error processing {tiff_file.name}: {e}")
+                failures += 1
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    
+    return layers_info, failures
+
+def create_overlay_manifest(layers_info):
+    """Return the manifest listing every overlay layer and its resolution variants."""
+    return {
+        'layers': [
+            {
+                'name': layer_info['layer_name'],
+                'type': layer_info['layer_type'],
+                'bounds': layer_info['bounds'],
+                'variants': layer_info['variants'],
+            }
+            for layer_info in layers_info
+        ]
+    }
+
+def prune_stale_overlays(output_dir, manifest):
+    """Delete the hashed PNGs of the manifest's layers that it no longer lists.
+    
+    Returns the number of files deleted. Files of layers missing from the
+    manifest (e.g. ones that failed to convert) are kept.
+    """
+    current = {Path(variant['url']).name
+               for layer in manifest['layers'] for variant in layer['variants']}
+    layer_names = {layer['name'] for layer in manifest['layers']}
+    
+    deleted = 0
+    for path in Path(output_dir).glob("*.png"):
+        match = HASHED_FILENAME.match(path.name)
+        if match and match.group('layer') in layer_names and path.name not in current:
+            path.unlink()
+            deleted += 1
+    return deleted
 
 def main():
     """Convert all GeoTIFF files to PNG overlays."""
     
+    parser = argparse.ArgumentParser(description='Convert GeoTIFF files to PNG overlays for Leaflet')
+    parser.add_argument('--palette', choices=PALETTES,
+                       help='Colour palette for all layers (default: chosen from each layer type)')
+    parser.add_argument('--strip-rows', type=int, default=STRIP_ROWS,
+                       help=f'Rows read and encoded at a time; bounds peak memory (default: {STRIP_ROWS})')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                       help='Number of files converted in parallel (default: number of CPUs)')
+    
+    args = parser.parse_args()
+    
     print("GeoTIFF to PNG Overlay Converter")
     print("=" * 50)
     
@@ -177,7 +371,8 @@ def main():
         print(f"Directory not found: {tiff_dir}")
         return
     
-    tiff_files = list(tiff_dir.glob("*.tiff")) + list(tiff_dir.glob("*.tif"))
+    # Optimized copies from optimize_geotiffs.py are used where available
+    tiff_files = find_tiff_files(tiff_dir)
     
     if not tiff_files:
         print(f"No TIFF files found in {tiff_dir}")
@@ -191,33 +386,34 @@ def main():
     print(f"Output directory: {output_dir}")
     print()
     
-    layers_info = []
-    
-    # Process each TIFF file
-    for tiff_file in sorted(tiff_files):
-        try:
-            layer_info = create_png_overlay(tiff_file, output_dir)
-            layers_info.append(layer_info)
-        except Exception as e:
-            print(f"❌ Error processing {tiff_file.name}: {e}")
+    # Process the TIFF files in parallel; results keep the file order
+    layers_info, failures = create_png_overlays(tiff_files, output_dir, palette=args.palette,
+                                                strip_rows=args.strip_rows, workers=args.workers)
     
-    # Generate integration code
-    js_code = create_leaflet_integration_code(layers_info)
+    # Manifest of every layer's hashed variants, loaded by the app on demand.
+    # It is replaced in one step so the app never fetches a partial manifest.
+    manifest = create_overlay_manifest(layers_info)
+    manifest_path = output_dir / "manifest.json"
+    temp_path = manifest_path.with_name(f".{manifest_path.name}.tmp")
+    with open(temp_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(temp_path, manifest_path)
     
-    # Save integration code
-    with open("sentinel_integration.js", "w") as f:
-        f.write(js_code)
+    deleted = prune_stale_overlays(output_dir, manifest)
     
     print(f"\n✅ Created {len(layers_info)} PNG overlays")
-    print("✅ Created sentinel_integration.js with Leaflet integration code")
+    if failures:
+        print(f"❌ {failures} files could not be converted")
+    print(f"✅ Created {manifest_path.name} listing each overlay's hashed resolution variants")
+    if deleted:
+        print(f"🗑️  Deleted {deleted} superseded overlay files")
     
     print("\n" + "=" * 50)
     print("NEXT STEPS:")
     print("=" * 50)
-    print("1. PNG files are in: public/sentinel_overlays/")
-    print("2. Integration code is in: sentinel_integration.js")
-    print("3. Add the layers to your MapComponent using the provided code")
-    print("4. Layers will be available as image overlays in your Leaflet map")
+    print("1. PNG files and manifest.json are in: public/sentinel_overlays/")
+    print("2. SentinelOverlaySelector loads manifest.json when an overlay is first shown")
+    print("3. Overlay URLs change whenever their content does, so they are served as immutable")
 
 if __name__ == "__main__":
     main()
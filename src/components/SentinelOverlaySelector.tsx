@@ -1,6 +1,6 @@
 'use client'
 
-import { useState } from 'react'
+import { useRef, useState } from 'react'
 import L from 'leaflet'
 
 interface SentinelOverlaySelectorProps {
@@ -11,19 +11,69 @@ interface SentinelLayer {
   name: string
   displayName: string
   type: 'vegetation' | 'moisture' | 'soil' | 'crop_cycles' | 'variety'
-  url: string
+  // Source GeoTIFF name, under which the manifest lists the overlay's hashed PNGs
+  source: string
   bounds: [[number, number], [number, number]]
   opacity: number
   description: string
   icon: string
 }
 
+interface OverlayVariant {
+  url: string
+  width: number
+  height: number
+  bytes: number
+  sha256: string
+}
+
+interface OverlayManifestLayer {
+  name: string
+  type: string
+  bounds: [[number, number], [number, number]]
+  variants: OverlayVariant[]
+}
+
+// Written by simple_raster_overlay.py next to the content-hashed overlay PNGs
+const OVERLAY_MANIFEST_URL = '/sentinel_overlays/manifest.json'
+
+let overlayManifest: Promise<Map<string, OverlayManifestLayer>> | null = null
+
+// Fetch the manifest once, on first use; a failed fetch is retried on the next toggle
+const loadOverlayManifest = () => {
+  if (!overlayManifest) {
+    overlayManifest = fetch(OVERLAY_MANIFEST_URL, { cache: 'no-cache' })
+      .then(response => {
+        if (!response.ok) throw new Error(`HTTP ${response.status}`)
+        return response.json()
+      })
+      .then(manifest => new Map<string, OverlayManifestLayer>(
+        (manifest.layers as OverlayManifestLayer[]).map(layer => [layer.name, layer])
+      ))
+    overlayManifest.catch(() => {
+      overlayManifest = null
+    })
+  }
+  return overlayManifest
+}
+
+// Pick the smallest variant at least as wide as the overlay is on screen
+const pickVariantUrl = (map: L.Map, manifestLayer: OverlayManifestLayer) => {
+  const bounds = L.latLngBounds(manifestLayer.bounds)
+  const west = map.latLngToLayerPoint(bounds.getNorthWest())
+  const east = map.latLngToLayerPoint(bounds.getSouthEast())
+  const screenWidth = (east.x - west.x) * (window.devicePixelRatio || 1)
+  const variants = [...manifestLayer.variants].sort((a, b) => a.width - b.width)
+  const variant = variants.find(v => v.width >= screenWidth) || variants[variants.length - 1]
+  return variant.url
+}
+
 const sentinelLayers: Record<string, SentinelLayer> = {
   ndvi: {
     name: 'ndvi',
     displayName: 'NDVI',
     type: 'vegetation',
-    url: '/sentinel_overlays/2019-06-03-00-00_2019-06-03-23-59_Sentinel-2_L2A_NDVI.png',
+    source: '2019-06-03-00-00_2019-06-03-23-59_Sentinel-2_L2A_NDVI',
     bounds: [[-20.520584, 57.546387], [-20.384847, 57.731781]],
     opacity: 0.7,
     description: 'Normalized Difference Vegetation Index - Plant health',
@@ -33,7 +83,7 @@ const sentinelLayers: Record<string, SentinelLayer> = {
     name: 'evi',
     displayName: 'EVI',
     type: 'vegetation',
-    url: '/sentinel_overlays/2019-06-03-00-00_2019-06-03-23-59_Sentinel-2_L2A_EVI.png',
+    source: '2019-06-03-00-00_2019-06-03-23-59_Sentinel-2_L2A_EVI',
     bounds: [[-20.520584, 57.546387], [-20.384847, 57.731781]],
     opacity: 0.7,
     description: 'Enhanced Vegetation Index - Improved vegetation analysis',
@@ -43,7 +93,7 @@ const sentinelLayers: Record<string, SentinelLayer> = {
     name: 'savi',
     displayName: 'SAVI',
     type: 'vegetation',
-    url: '/sentinel_overlays/2019-06-03-00-00_2019-06-03-23-59_Sentinel-2_L2A_SAVI.png',
+    source: '2019-06-03-00-00_2019-06-03-23-59_Sentinel-2_L2A_SAVI',
     bounds: [[-20.520584, 57.546387], [-20.384847, 57.731781]],
     opacity: 0.7,
     description: 'Soil-Adjusted Vegetation Index - Reduces soil background',
@@ -53,7 +103,7 @@ const sentinelLayers: Record<string, SentinelLayer> = {
     name: 'agriculture',
     displayName: 'Agriculture',
     type: 'vegetation',
-    url: '/sentinel_overlays/2019-06-03-00-00_2019-06-03-23-59_Sentinel-2_L2A_Agriculture.png',
+    source: '2019-06-03-00-00_2019-06-03-23-59_Sentinel-2_L2A_Agriculture',
     bounds: [[-20.520584, 57.546387], [-20.384847, 57.731781]],
     opacity: 0.7,
     description: 'Agricultural areas identification',
@@ -63,7 +113,7 @@ const sentinelLayers: Record<string, SentinelLayer> = {
     name: 'moisture_index',
     displayName: 'Moisture Index',
     type: 'moisture',
-    url: '/sentinel_overlays/2019-06-03-00-00_2019-06-03-23-59_Sentinel-2_L2A_Moisture_Index.png',
+    source: '2019-06-03-00-00_2019-06-03-23-59_Sentinel-2_L2A_Moisture_Index',
     bounds: [[-20.520584, 57.546387], [-20.384847, 57.731781]],
     opacity: 0.7,
     description: 'Soil moisture content analysis',
@@ -73,7 +123,7 @@ const sentinelLayers: Record<string, SentinelLayer> = {
     name: 'moisture_stress',
     displayName: 'Moisture Stress',
     type: 'moisture',
-    url: '/sentinel_overlays/2019-06-03-00-00_2019-06-03-23-59_Sentinel-2_L2A_Moisture_Stress.png',
+    source: '2019-06-03-00-00_2019-06-03-23-59_Sentinel-2_L2A_Moisture_Stress',
     bounds: [[-20.520584, 57.546387], [-20.384847, 57.731781]],
     opacity: 0.7,
     description: 'Plant water stress indicators',
@@ -83,7 +133,7 @@ const sentinelLayers: Record<string, SentinelLayer> = {
     name: 'barren_soil',
     displayName: 'Barren Soil',
     type: 'soil',
-    url: '/sentinel_overlays/2019-06-03-00-00_2019-06-03-23-59_Sentinel-2_L2A_Barren_Soil.png',
+    source: '2019-06-03-00-00_2019-06-03-23-59_Sentinel-2_L2A_Barren_Soil',
     bounds: [[-20.520584, 57.546387], [-20.384847, 57.731781]],
     opacity: 0.7,
     description: 'Exposed soil and bare ground areas',
@@ -94,39 +144,66 @@ const sentinelLayers: Record<string, SentinelLayer> = {
 export default function SentinelOverlaySelector({ map }: SentinelOverlaySelectorProps) {
   const [isOpen, setIsOpen] = useState(false)
   const [activeOverlays, setActiveOverlays] = useState<Set<string>>(new Set())
-  const [overlayInstances, setOverlayInstances] = useState<Map<string, L.ImageOverlay>>(new Map())
+  // Overlays on the map, kept in refs so toggles finishing after an await see current values
+  const overlayInstances = useRef<Map<string, L.ImageOverlay>>(new Map())
+  const pendingLayers = useRef<Set<string>>(new Set())
 
-  const toggleOverlay = (layerName: string) => {
+  const toggleOverlay = async (layerName: string) => {
     if (!map) return
 
     const layer = sentinelLayers[layerName]
-    if (!layer) return
-
-    const newActiveOverlays = new Set(activeOverlays)
-    const newOverlayInstances = new Map(overlayInstances)
+    if (!layer || pendingLayers.current.has(layerName)) return
 
-    if (activeOverlays.has(layerName)) {
+    const overlayInstance = overlayInstances.current.get(layerName)
+    if (overlayInstance) {
       // Remove overlay
-      const overlayInstance = overlayInstances.get(layerName)
-      if (overlayInstance) {
-        map.removeLayer(overlayInstance)
-        newOverlayInstances.delete(layerName)
-      }
-      newActiveOverlays.delete(layerName)
-    } else {
-      // Add overlay
-      const imageOverlay = L.imageOverlay(layer.url, layer.bounds, {
-        opacity: layer.opacity,
-        interactive: false
+      map.removeLayer(overlayInstance)
+      overlayInstances.current.delete(layerName)
+      setActiveOverlays(previous => {
+        const next = new Set(previous)
+        next.delete(layerName)
+        return next
       })
-      
-      imageOverlay.addTo(map)
-      newOverlayInstances.set(layerName, imageOverlay)
-      newActiveOverlays.add(layerName)
+      return
+    }
+
+    // Add overlay from the manifest's hashed variants; overlay PNGs are only
+    // written under hashed names, so there is nothing to show without it.
+    // Clicks on this layer are ignored until the manifest has loaded.
+    pendingLayers.current.add(layerName)
+    let manifestLayer: OverlayManifestLayer | undefined
+    try {
+      manifestLayer = (await loadOverlayManifest()).get(layer.source)
+    } catch (error) {
+      console.error('❌ Could not load the Sentinel overlay manifest:', error)
+      return
+    } finally {
+      pendingLayers.current.delete(layerName)
     }
 
-    setActiveOverlays(newActiveOverlays)
-    setOverlayInstances(newOverlayInstances)
+    if (!manifestLayer?.variants.length) {
+      console.warn('⚠️ Sentinel overlay missing from the manifest:', layer.source)
+      return
+    }
+
+    const variantLayer = manifestLayer
+    const imageOverlay = L.imageOverlay(
+      pickVariantUrl(map, variantLayer),
+      variantLayer.bounds ?? layer.bounds,
+      {
+        opacity: layer.opacity,
+        interactive: false
+      }
+    )
+
+    // Switch to the variant that fits the new zoom, until the overlay is removed
+    const updateVariant = () => imageOverlay.setUrl(pickVariantUrl(map, variantLayer))
+    map.on('zoomend', updateVariant)
+    imageOverlay.on('remove', () => map.off('zoomend', updateVariant))
+
+    imageOverlay.addTo(map)
+    overlayInstances.current.set(layerName, imageOverlay)
+    setActiveOverlays(previous => new Set(previous).add(layerName))
   }
 
   const getTypeColor = (type: string) => {
@@ -225,11 +302,11 @@ export default function SentinelOverlaySelector({ map }: SentinelOverlaySelector
                   type="button"
                   onClick={() => {
                     // Clear all overlays
-                    overlayInstances.forEach((overlay) => {
+                    overlayInstances.current.forEach((overlay) => {
                       if (map) map.removeLayer(overlay)
                     })
+                    overlayInstances.current.clear()
                     setActiveOverlays(new Set())
-                    setOverlayInstances(new Map())
                   }}
                   className="text-xs text-red-600 hover:text-red-700 font-medium"
                 >
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+"""
+Checks for the tile generator in create_tile_server.py.
+Run with: python -m pytest test_create_tile_server.py
+"""
+
+import argparse
+import importlib.util
+import json
+import socket
+import threading
+import time
+import urllib.error
+import urllib.request
+
+import numpy as np
+import pytest
+import rasterio
+from rasterio.warp import transform_geom
+
+import create_tile_server
+from create_tile_server import (DynamicTileRenderer, PMTilesTileStore, TileCache, create_simple_tile_server,
+                                create_tiles_for_geotiff, decode_tile, get_geographic_bounds, parse_bands)
+from tile_grid import tile_range
+
+def write_field(path, left, bottom, right, top):
+    """Write a GeoJSON with one rectangular field, given in EPSG:32740 coordinates."""
+    ring = [[left, bottom], [right, bottom], [right, top], [left, top], [left, bottom]]
+    geometry = transform_geom('EPSG:32740', 'EPSG:4326', {'type': 'Polygon', 'coordinates': [ring]})
+    with open(path, 'w') as f:
+        json.dump({'type': 'FeatureCollection',
+                   'features': [{'type': 'Feature', 'properties': {'id': 'F1'}, 'geometry': geometry}]}, f)
+
+def test_field_pyramid_has_no_opaque_black(tmp_path, write_raster):
+    """Parents of tiles skipped outside the fields leave those quadrants transparent."""
+    data = np.random.default_rng(0).uniform(0.2, 0.8, size=(1024, 1024))
+    tiff_file = tmp_path / "scene_NDVI.tif"
+    write_raster(tiff_file, data)
+    fields_path = tmp_path / "fields.geojson"
+    write_field(fields_path, 566000, 7738000, 566300, 7738300)
+
+    layer_dir = create_tiles_for_geotiff(tiff_file, tmp_path / "tiles", min_zoom=12, max_zoom=15,
+                                         pyramid=True, fields_path=fields_path)
+
+    tile_paths = sorted(layer_dir.glob("*/*/*.png"))
+    assert {path.parent.parent.name for path in tile_paths} == {"12", "13", "14", "15"}
+    for tile_path in tile_paths:
+        tile = decode_tile(tile_path.read_bytes())
+        opaque = tile[..., 3] == 255 if tile.shape[2] == 4 else np.ones(tile.shape[:2], dtype=bool)
+        black = (tile[..., :3] == 0).all(axis=2)
+        assert not (opaque & black).any(), tile_path
+
+@pytest.mark.parametrize("value", ["1,2", "0,1,2", "1,2,3,3", "1,x,3"])
+def test_bands_must_be_three_band_indexes(value):
+    """--bands is rejected up front rather than failing on every tile."""
+    with pytest.raises(argparse.ArgumentTypeError):
+        parse_bands(value)
+
+def test_bands_are_parsed_in_order():
+    assert parse_bands("4,3,2") == (4, 3, 2)
+
+def test_bands_beyond_the_band_count_fail_before_tiling(tmp_path, write_raster):
+    tiff_file = tmp_path / "scene_Agriculture.tif"
+    write_raster(tiff_file, np.full((3, 256, 256), 100), dtype='uint8', nodata=None)
+
+    with pytest.raises(ValueError):
+        create_tiles_for_geotiff(tiff_file, tmp_path / "tiles", min_zoom=12, max_zoom=12, bands=(1, 2, 4))
+    assert not (tmp_path / "tiles").exists()
+
+def test_dynamic_cache_hits_open_no_files(tmp_path, monkeypatch, write_raster):
+    """New connection threads serve cached tiles, and render others, without reopening the GeoTIFF."""
+    tiff_dir = tmp_path / "tiffs"
+    tiff_dir.mkdir()
+    write_raster(tiff_dir / "scene_NDVI.tif", np.random.default_rng(4).uniform(0.2, 0.8, size=(256, 256)))
+    renderer = DynamicTileRenderer(tiff_dir, TileCache())
+    with rasterio.open(tiff_dir / "scene_NDVI.tif") as dataset:
+        min_tile_x, _, min_tile_y, _ = tile_range(get_geographic_bounds(dataset), 14)
+    tile_bytes = renderer.get_tile("scene_NDVI", 14, min_tile_x, min_tile_y)
+    assert tile_bytes
+
+    def no_open(*args, **kwargs):
+        raise AssertionError("GeoTIFF reopened")
+    monkeypatch.setattr(create_tile_server.rasterio, "open", no_open)
+    results = []
+    thread = threading.Thread(target=lambda: results.extend([
+        renderer.get_tile("scene_NDVI", 14, min_tile_x, min_tile_y),
+        renderer.get_tile("scene_NDVI", 15, 2 * min_tile_x + 1, 2 * min_tile_y + 1),
+    ]))
+    thread.start()
+    thread.join()
+    assert results[0] == tile_bytes
+    assert results[1] is not None
+
+def load_tile_server(tmp_path, monkeypatch):
+    """Generate tile_server.py in tmp_path and import it."""
+    monkeypatch.chdir(tmp_path)
+    create_simple_tile_server()
+    spec = importlib.util.spec_from_file_location("tile_server", tmp_path / "tile_server.py")
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def test_idle_keep_alive_connections_do_not_block_requests(tmp_path, monkeypatch):
+    """Idle keep-alive connections, ~6 per browser tab, must not hold up new clients."""
+    tile_server = load_tile_server(tmp_path, monkeypatch)
+    tile_server.TILES_DIR.mkdir()
+    httpd = tile_server.TileHTTPServer(("127.0.0.1", 0), tile_server.TileHandler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    port = httpd.server_address[1]
+    idle = [socket.create_connection(("127.0.0.1", port)) for _ in range(64)]
+    try:
+        start = time.perf_counter()
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/", timeout=5) as response:
+            assert response.status == 200
+        assert time.perf_counter() - start < 2
+    finally:
+        for connection in idle:
+            connection.close()
+        httpd.shutdown()
+        httpd.server_close()
+
+def test_pmtiles_round_trip_through_leaf_directories(tmp_path, monkeypatch):
+    """Every tile written to a PMTiles archive too large for one root directory reads back."""
+    tile_server = load_tile_server(tmp_path, monkeypatch)
+    rng = np.random.default_rng(0)
+    tiles = {}
+    # A zoom level of identical tiles, stored as runs
+    for tile_x in range(8):
+        for tile_y in range(8):
+            tiles[(3, tile_x, tile_y)] = b"same"
+    # Scattered distinct tiles, too many entries for the root directory alone
+    for tile_x, tile_y in rng.integers(0, 2 ** 12, size=(20000, 2)):
+        tiles[(12, int(tile_x), int(tile_y))] = rng.bytes(int(rng.integers(1, 40)))
+
+    store = PMTilesTileStore(tmp_path / "layer.pmtiles")
+    store.write_metadata({'format': 'png', 'minzoom': '3', 'maxzoom': '12'})
+    for (zoom, tile_x, tile_y), tile_bytes in tiles.items():
+        store.write_tile(zoom, tile_x, tile_y, tile_bytes)
+    store.close()
+
+    archive = tile_server.PMTilesArchive(tmp_path / "layer.pmtiles")
+    assert any(run_length == 0 for _, _, run_length in archive.root[1])
+    for (zoom, tile_x, tile_y), tile_bytes in tiles.items():
+        assert archive.get_tile(zoom, tile_x, tile_y) == tile_bytes, (zoom, tile_x, tile_y)
+    assert archive.get_tile(4, 0, 0) is None
+    assert archive.extension == "png"
+
+def test_only_one_prewarm_runs_at_a_time(tmp_path, monkeypatch):
+    """POST /_prewarm is refused with 409 while another prewarm is running."""
+    tile_server = load_tile_server(tmp_path, monkeypatch)
+    tile_server.TILES_DIR.mkdir()
+    httpd = tile_server.TileHTTPServer(("127.0.0.1", 0), tile_server.TileHandler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{httpd.server_address[1]}/_prewarm?tiles=10"
+    try:
+        with tile_server.prewarm_lock:
+            with pytest.raises(urllib.error.HTTPError) as error:
+                urllib.request.urlopen(urllib.request.Request(url, method="POST"), timeout=5)
+            assert error.value.code == 409
+        with urllib.request.urlopen(urllib.request.Request(url, method="POST"), timeout=5) as response:
+            assert response.status == 202
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
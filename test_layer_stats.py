@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""
+Checks for the layer stretch statistics in layer_stats.py.
+Run with: python -m pytest test_layer_stats.py
+"""
+
+import json
+
+import numpy as np
+import pytest
+import rasterio
+
+import layer_stats
+from layer_stats import (STATS_VERSION, band_value_ranges, compute_layer_stats, layer_value_range,
+                         stats_path)
+
+def test_outlier_does_not_move_the_stretch(tmp_path, write_raster):
+    """One extreme pixel must not drag the 2nd/98th percentiles towards it."""
+    data = np.random.default_rng(0).random((1000, 1000)).astype('float32')
+    data[500, 500] = 1e6
+    tiff_file = tmp_path / "outlier.tif"
+    write_raster(tiff_file, data)
+
+    band = compute_layer_stats(tiff_file)['bands'][0]
+
+    expected = np.percentile(data, [2, 98])
+    assert np.allclose([band['percentiles']['2'], band['percentiles']['98']], expected, atol=1e-6)
+    assert band['max'] == 1e6
+    assert layer_value_range(tiff_file, "default") == tuple(band['percentiles'].values())
+
+def test_nodata_is_left_out(tmp_path, write_raster):
+    """NaN pixels are not part of the sample."""
+    data = np.full((256, 256), np.nan, dtype='float32')
+    data[:128] = np.linspace(0, 1, 128 * 256).reshape(128, 256)
+    tiff_file = tmp_path / "nodata.tif"
+    write_raster(tiff_file, data)
+
+    stats = compute_layer_stats(tiff_file)
+
+    assert stats['sample_pixels'] == 128 * 256
+    assert stats['bands'][0]['min'] == 0.0
+    assert stats['bands'][0]['max'] == 1.0
+
+def test_outdated_sidecar_is_recomputed(tmp_path, write_raster):
+    """Sidecars written by an older statistics version are not trusted."""
+    data = np.random.default_rng(1).random((256, 256)).astype('float32')
+    tiff_file = tmp_path / "stale.tif"
+    write_raster(tiff_file, data)
+    with open(stats_path(tiff_file), 'w') as f:
+        json.dump({'bands': [{'min': 0, 'max': 1, 'percentiles': {'2': 5.0, '98': 9.0}}]}, f)
+
+    low, high = layer_value_range(tiff_file, "default")
+
+    assert np.allclose((low, high), np.percentile(data, [2, 98]), atol=1e-6)
+    with open(stats_path(tiff_file)) as f:
+        assert json.load(f)['version'] == STATS_VERSION
+
+def test_composite_bands_use_their_own_percentiles(tmp_path, write_raster):
+    """uint16 reflectance bands are stretched over their data, not the whole dtype range."""
+    data = np.random.default_rng(2).integers(1, 10000, size=(3, 256, 256)).astype('uint16')
+    data[2] //= 4
+    tiff_file = tmp_path / "composite.tif"
+    write_raster(tiff_file, data, dtype='uint16', nodata=0)
+
+    ranges = band_value_ranges(tiff_file, (1, 2, 3), 'uint16')
+
+    for band in range(3):
+        assert np.allclose(ranges[band], np.percentile(data[band], [2, 98]))
+
+def test_composite_without_data_falls_back_to_dtype_range(tmp_path, write_raster):
+    """Bands without statistics span their dtype's full range."""
+    tiff_file = tmp_path / "empty.tif"
+    write_raster(tiff_file, np.zeros((3, 64, 64)), dtype='uint16', nodata=0)
+
+    assert band_value_ranges(tiff_file, (1, 2, 3), 'uint16') == [(0, 65535)] * 3
+
+@pytest.mark.parametrize("overviews, sample_pixels", [([], 256 * 1024), ([2], 64 * 1024)])
+def test_subsample_covers_the_whole_raster(tmp_path, write_raster, monkeypatch, overviews, sample_pixels):
+    """The sampled blocks span the raster, so a west/east split still gets the full stretch.
+    
+    Without overviews, or with a lone 1/2 one, the level read holds four
+    times the sample, and a sample from one block column or corner would
+    miss the east half.
+    """
+    monkeypatch.setattr(layer_stats, 'STATS_SAMPLE_PIXELS', sample_pixels)
+    rng = np.random.default_rng(3)
+    data = np.empty((1024, 1024), dtype='float32')
+    data[:, :512] = rng.uniform(0, 0.1, size=(1024, 512))
+    data[:, 512:] = rng.uniform(0.9, 1.0, size=(1024, 512))
+    tiff_file = tmp_path / "halves.tif"
+    write_raster(tiff_file, data)
+    if overviews:
+        with rasterio.open(tiff_file, 'r+') as dst:
+            dst.build_overviews(overviews)
+
+    stats = compute_layer_stats(tiff_file)
+
+    assert stats['overview_level'] == (0 if overviews else None)
+    assert 0 < stats['sample_pixels'] <= 2 * sample_pixels
+    percentiles = stats['bands'][0]['percentiles']
+    assert np.allclose([percentiles['2'], percentiles['98']], np.percentile(data, [2, 98]), atol=0.05)
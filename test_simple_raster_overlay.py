@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""
+Checks for the streaming PNG overlay writer in simple_raster_overlay.py.
+Run with: python -m pytest test_simple_raster_overlay.py
+"""
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from simple_raster_overlay import PNGStreamWriter
+
+def write_png(path, pixels, strip_rows):
+    """Write pixels with PNGStreamWriter in strips of the given heights; return the writer."""
+    mode = "RGBA" if pixels.shape[2] == 4 else "RGB"
+    with PNGStreamWriter(path, pixels.shape[1], pixels.shape[0], mode) as writer:
+        row = 0
+        for rows in strip_rows:
+            writer.write_rows(pixels[row:row + rows])
+            row += rows
+    return writer
+
+def test_hash_does_not_depend_on_strips(tmp_path):
+    """The same pixels written in different strips give the same file and content hash."""
+    pixels = np.random.default_rng(0).integers(0, 256, size=(1024, 300, 4), dtype=np.uint8)
+
+    by_256 = write_png(tmp_path / "a.png", pixels, [256] * 4)
+    by_512 = write_png(tmp_path / "b.png", pixels, [512] * 2)
+
+    assert by_256.sha256.hexdigest() == by_512.sha256.hexdigest()
+    assert (tmp_path / "a.png").read_bytes() == (tmp_path / "b.png").read_bytes()
+
+@pytest.mark.parametrize("mode", ["RGB", "RGBA"])
+def test_pillow_decodes_the_same_pixels(tmp_path, mode):
+    """Uneven strips of Sub-filtered rows decode back to exactly the pixels written."""
+    pixels = np.random.default_rng(1).integers(0, 256, size=(301, 97, len(mode)), dtype=np.uint8)
+    # Smooth gradients too, where the Sub filter's wraparound matters
+    pixels[:100] = np.arange(97, dtype=np.uint8)[None, :, None] * 3
+
+    write_png(tmp_path / "overlay.png", pixels, [1, 150, 7, 143])
+
+    with Image.open(tmp_path / "overlay.png") as image:
+        assert image.mode == mode
+        assert np.array_equal(np.asarray(image), pixels)
+
+def test_wrong_rows_are_rejected(tmp_path):
+    """Rows of the wrong shape, too many rows or too few are a ValueError."""
+    with PNGStreamWriter(tmp_path / "shape.png", 10, 4, "RGBA") as writer:
+        with pytest.raises(ValueError):
+            writer.write_rows(np.zeros((2, 10, 3), dtype=np.uint8))
+        with pytest.raises(ValueError):
+            writer.write_rows(np.zeros((2, 9, 4), dtype=np.uint8))
+        writer.write_rows(np.zeros((3, 10, 4), dtype=np.uint8))
+        with pytest.raises(ValueError):
+            writer.write_rows(np.zeros((2, 10, 4), dtype=np.uint8))
+        writer.write_rows(np.zeros((1, 10, 4), dtype=np.uint8))
+
+    writer = PNGStreamWriter(tmp_path / "short.png", 10, 4, "RGBA")
+    writer.write_rows(np.zeros((3, 10, 4), dtype=np.uint8))
+    with pytest.raises(ValueError):
+        writer.close()
@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+"""
+Checks for the per-field statistics in zonal_stats.py.
+Run with: python -m pytest test_zonal_stats.py
+"""
+
+import numpy as np
+
+from zonal_stats import ZONAL_PERCENTILES, zonal_statistics
+
+def test_matches_numpy_per_zone():
+    """Counts, means and percentiles agree with np.mean and np.percentile zone by zone."""
+    rng = np.random.default_rng(0)
+    values = rng.normal(0.5, 0.2, size=(200, 300)).astype('float32')
+    labels = rng.integers(0, 6, size=values.shape)
+    # Zone 6 gets a single pixel and zone 7 none; label 0 is outside every zone
+    labels[labels == 5] = 4
+    labels[0, 0] = 6
+    zone_count = 7
+
+    stats = zonal_statistics(values, labels, zone_count)
+
+    for zone in range(1, zone_count + 1):
+        zone_values = values[labels == zone].astype(np.float64)
+        assert stats['count'][zone - 1] == zone_values.size
+        if zone_values.size == 0:
+            for name in ['mean', *ZONAL_PERCENTILES]:
+                assert np.isnan(stats[name][zone - 1])
+            continue
+        assert np.isclose(stats['mean'][zone - 1], zone_values.mean())
+        for name, percentile in ZONAL_PERCENTILES.items():
+            assert np.isclose(stats[name][zone - 1], np.percentile(zone_values, percentile)), (zone, name)
+    assert stats['median'][5] == values[0, 0]
+
+def test_empty_input():
+    """No values at all gives zero counts and NaN statistics for every zone."""
+    stats = zonal_statistics([], [], 3)
+
+    assert list(stats['count']) == [0, 0, 0]
+    for name in ['mean', *ZONAL_PERCENTILES]:
+        assert np.isnan(stats[name]).all()
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""
+XYZ tile grid math shared by the tiler, the tile server and the coverage tools.
+
+The coordinate functions accept NumPy arrays of tile numbers as well as
+plain numbers, so a whole zoom level is converted in one vectorized pass
+instead of one Python call per tile.
+"""
+
+import numpy as np
+
+# Web Mercator (EPSG:3857) extent and tile size in pixels
+WEB_MERCATOR_HALF_WORLD = 20037508.342789244
+TILE_SIZE = 256
+
+def tile_span(zoom):
+    """Return the width of one tile at a zoom level in Web Mercator metres."""
+    return 2 * WEB_MERCATOR_HALF_WORLD / 2 ** zoom
+
+def deg2num(lat_deg, lon_deg, zoom):
+    """Convert lat/lon to (x, y) tile numbers, clamped to the zoom level's grid."""
+    lat_rad = np.radians(lat_deg)
+    n = 2 ** zoom
+    xtile = np.floor((np.asarray(lon_deg) + 180.0) / 360.0 * n)
+    ytile = np.floor((1.0 - np.arcsinh(np.tan(lat_rad)) / np.pi) / 2.0 * n)
+    xtile = np.clip(xtile, 0, n - 1).astype(np.int64)
+    ytile = np.clip(ytile, 0, n - 1).astype(np.int64)
+    if xtile.ndim == 0:
+        return (int(xtile), int(ytile))
+    return (xtile, ytile)
+
+def num2deg(xtile, ytile, zoom):
+    """Convert tile numbers to the (lat, lon) of their north-west corners."""
+    n = 2 ** zoom
+    lon_deg = np.asarray(xtile) / n * 360.0 - 180.0
+    lat_deg = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * np.asarray(ytile) / n))))
+    return (lat_deg, lon_deg)
+
+def tile_range(bounds, zoom):
+    """Return (min_x, max_x, min_y, max_y) of the tiles covering lon/lat bounds."""
+    # Tile y grows southwards, so the top-left corner gives the minimum y
+    (min_tile_x, max_tile_x), (min_tile_y, max_tile_y) = deg2num(
+        np.array([bounds.top, bounds.bottom]), np.array([bounds.left, bounds.right]), zoom
+    )
+    return int(min_tile_x), int(max_tile_x), int(min_tile_y), int(max_tile_y)
+
+def range_tiles(min_tile_x, max_tile_x, min_tile_y, max_tile_y):
+    """Return (xs, ys) arrays of every tile in a range, column by column."""
+    xs, ys = np.meshgrid(np.arange(min_tile_x, max_tile_x + 1, dtype=np.int64),
+                         np.arange(min_tile_y, max_tile_y + 1, dtype=np.int64), indexing='ij')
+    return xs.ravel(), ys.ravel()
+
+def tile_bounds(xtile, ytile, zoom):
+    """Return (west, south, east, north) of tiles in Web Mercator metres."""
+    size = tile_span(zoom)
+    west = -WEB_MERCATOR_HALF_WORLD + np.asarray(xtile) * size
+    north = WEB_MERCATOR_HALF_WORLD - np.asarray(ytile) * size
+    return (west, north - size, west + size, north)
+
+def grid_transform(zoom, min_tile_x, min_tile_y, pixels_per_tile=1):
+    """Return the (a, b, c, d, e, f) affine coefficients of a zoom level's pixel grid.
+    
+    The grid's origin is the north-west corner of tile (min_tile_x,
+    min_tile_y); with pixels_per_tile=1 each pixel is one tile.
+    """
+    size = tile_span(zoom)
+    west, _, _, north = tile_bounds(min_tile_x, min_tile_y, zoom)
+    return (size / pixels_per_tile, 0.0, float(west), 0.0, -size / pixels_per_tile, float(north))
+
+def tile_windows(xtile, ytile, zoom, transform, size=1):
+    """Return (col_off, row_off, width, height) pixel windows of size x size tile blocks.
+    
+    transform is the north-up affine transform (e.g. a rasterio dataset's)
+    of a raster in Web Mercator. Windows are fractional and not clipped to
+    the raster.
+    """
+    west, north = tile_bounds(xtile, ytile, zoom)[::3]
+    span = tile_span(zoom) * size
+    col_off = (west - transform.c) / transform.a
+    row_off = (north - transform.f) / transform.e
+    return (col_off, row_off, span / transform.a, span / -transform.e)
+
+def parent(xtile, ytile):
+    """Return the tile numbers of the parents, one zoom level up."""
+    return (np.asarray(xtile) >> 1, np.asarray(ytile) >> 1)
+
+def children(xtile, ytile):
+    """Return (xs, ys) of the four children one zoom level down, as (..., 4) arrays.
+    
+    Children are ordered (0, 0), (0, 1), (1, 0), (1, 1) by (dx, dy).
+    """
+    dx = np.array([0, 0, 1, 1])
+    dy = np.array([0, 1, 0, 1])
+    return (2 * np.asarray(xtile)[..., np.newaxis] + dx,
+            2 * np.asarray(ytile)[..., np.newaxis] + dy)
+
+def quadkey(zoom, xtile, ytile):
+    """Return the Bing-style quadkey string of a tile, or a string array for arrays of tiles."""
+    xtile = np.asarray(xtile, dtype=np.int64)
+    ytile = np.asarray(ytile, dtype=np.int64)
+    if zoom == 0:
+        keys = np.full(xtile.shape, "")
+    else:
+        # One ASCII digit per zoom level, most significant first, viewed as fixed-width strings
+        bits = np.arange(zoom - 1, -1, -1)
+        digits = ((xtile[..., np.newaxis] >> bits) & 1) + 2 * ((ytile[..., np.newaxis] >> bits) & 1)
+        codes = (digits + ord("0")).astype(np.uint8)
+        keys = codes.view(f"S{zoom}")[..., 0].astype(str)
+    return keys.item() if keys.ndim == 0 else keys
+
+def quadkey_to_tile(key):
+    """Return (zoom, x, y) of a quadkey string."""
+    tile_x = tile_y = 0
+    for digit in key:
+        digit = int(digit)
+        tile_x = (tile_x << 1) | (digit & 1)
+        tile_y = (tile_y << 1) | (digit >> 1)
+    return len(key), tile_x, tile_y
+
+def tms_row(zoom, ytile):
+    """Return the TMS row (origin in the south, as used by MBTiles) of XYZ tile rows."""
+    return (2 ** zoom - 1) - ytile
+
+def zxy_to_tile_id(zoom, tile_x, tile_y):
+    """Return the PMTiles tile id: the number of tiles at lower zooms plus the
+    tile's position along the zoom level's Hilbert curve."""
+    tile_id = ((1 << (2 * zoom)) - 1) // 3
+    size = 1 << zoom
+    step = size // 2
+    while step > 0:
+        rx = 1 if tile_x & step else 0
+        ry = 1 if tile_y & step else 0
+        tile_id += step * step * ((3 * rx) ^ ry)
+        if ry == 0:
+            if rx == 1:
+                tile_x = size - 1 - tile_x
+                tile_y = size - 1 - tile_y
+            tile_x, tile_y = tile_y, tile_x
+        step //= 2
+    return tile_id
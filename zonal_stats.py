@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+"""
+Script to compute per-field statistics of the Sentinel-2 index rasters.
+
+For every field in estate_fields.geojson and every scene, the mean,
+median, 10th and 90th percentiles and valid pixel count of the index are
+computed from the pixels whose centres fall inside the field.
+
+The field polygons are rasterized once per raster grid into a label array
+(0 outside every field, i + 1 inside field i) that is reused by every
+scene sharing that grid. Each scene is then a single vectorized pass over
+its in-field pixels: counts and sums come from np.bincount, and the
+percentiles from one sort of the pixels by field and value.
+"""
+
+import re
+import csv
+import json
+import math
+import time
+import argparse
+from pathlib import Path
+
+import numpy as np
+
+from optimize_geotiffs import find_tiff_files
+
+FIELDS_GEOJSON = "estate_fields.geojson"
+
+# Layers whose statistics are computed, matched against the file name
+ZONAL_LAYERS = ("NDVI", "EVI", "Moisture")
+
+# Percentiles reported for each field, besides the mean
+ZONAL_PERCENTILES = {'p10': 10, 'median': 50, 'p90': 90}
+
+STAT_COLUMNS = ['count', 'mean', *ZONAL_PERCENTILES]
+
+# "2019-06-03-00-00_2019-06-03-23-59_Sentinel-2_L2A_NDVI" -> ("2019-06-03", "NDVI")
+SCENE_NAME = re.compile(r"^(?P<date>\d{4}-\d{2}-\d{2})[-\d]*_[-\d]*_Sentinel-2_L[12][AC]_(?P<index>.+)$")
+
+def parse_scene_name(layer_name):
+    """Return the (date, index) of a scene file stem, or (None, layer_name) if it does not match."""
+    match = SCENE_NAME.match(layer_name)
+    if match is None:
+        return None, layer_name
+    return match.group('date'), match.group('index')
+
+class FieldZones:
+    """The field polygons of an estate and their label rasters, cached per raster grid."""
+    
+    def __init__(self, field_ids, geometries):
+        self.field_ids = list(field_ids)
+        self.geometries = list(geometries)
+        self._labels = {}
+    
+    @classmethod
+    def from_geojson(cls, geojson_path):
+        """Load the fields of a GeoJSON file, identified by their 'id' property."""
+        with open(geojson_path) as f:
+            geojson = json.load(f)
+        
+        features = [feature for feature in geojson['features'] if feature.get('geometry')]
+        field_ids = [feature.get('properties', {}).get('id') or str(number)
+                     for number, feature in enumerate(features, start=1)]
+        return cls(field_ids, [feature['geometry'] for feature in features])
+    
+    def __len__(self):
+        return len(self.field_ids)
+    
+    def labels(self, src):
+        """Return (window, labels) of the fields on a dataset's grid.
+        
+        window is the part of the dataset covering the fields, or None if
+        they miss it, and labels its (rows, cols) int32 label array. Where
+        fields overlap, the later one in the file takes the pixel. Results
+        are cached by CRS, transform and size, so scenes on the same grid
+        rasterize the fields only once.
+        """
+        key = (src.crs.to_wkt() if src.crs else None, tuple(src.transform), src.width, src.height)
+        if key not in self._labels:
+            self._labels[key] = self._rasterize(src)
+        return self._labels[key]
+    
+    def _rasterize(self, src):
+        from rasterio.features import bounds as geometry_bounds, rasterize
+        from rasterio.warp import transform_geom
+        from rasterio.errors import WindowError
+        from rasterio.windows import Window, from_bounds
+        
+        geometries = [transform_geom("EPSG:4326", src.crs, geometry) for geometry in self.geometries]
+        
+        # Only the window around the fields is labelled and read
+        all_bounds = np.array([geometry_bounds(geometry) for geometry in geometries])
+        window = from_bounds(all_bounds[:, 0].min(), all_bounds[:, 1].min(),
+                             all_bounds[:, 2].max(), all_bounds[:, 3].max(), src.transform)
+        col_off, row_off = math.floor(window.col_off), math.floor(window.row_off)
+        window = Window(col_off, row_off,
+                        math.ceil(window.col_off + window.width) - col_off,
+                        math.ceil(window.row_off + window.height) - row_off)
+        try:
+            window = window.intersection(Window(0, 0, src.width, src.height))
+        except WindowError:
+            # The fields are outside the raster
+            return None, None
+        
+        labels = rasterize(((geometry, number) for number, geometry in enumerate(geometries, start=1)),
+                           out_shape=(window.height, window.width),
+                           transform=src.window_transform(window), fill=0, dtype='int32')
+        return window, labels
+
+def zonal_statistics(values, labels, zone_count, percentiles=ZONAL_PERCENTILES):
+    """Return the count, mean and percentiles of values in each zone.
+    
+    labels holds each value's zone, 1 to zone_count; values labelled 0
+    are ignored. Returns a dict of (zone_count,) arrays keyed by 'count',
+    'mean' and the names in percentiles; zones without values get NaN.
+    Percentiles interpolate linearly, like np.percentile.
+    """
+    values = np.asarray(values).ravel()
+    labels = np.asarray(labels, dtype=np.int64).ravel()
+    inside = labels > 0
+    values, zones = values[inside], labels[inside] - 1
+    
+    counts = np.bincount(zones, minlength=zone_count)
+    sums = np.bincount(zones, weights=values, minlength=zone_count)
+    
+    with np.errstate(invalid='ignore', divide='ignore'):
+        results = {'count': counts, 'mean': sums / counts}
+    
+    # Sort by value, then stably by zone, so each zone's values are one sorted
+    # run. A stable sort of 8- or 16-bit zones is a radix sort, several times
+    # quicker than np.lexsort.
+    order = np.argsort(values)
+    zone_order = np.argsort(zones[order].astype(np.min_scalar_type(zone_count)), kind='stable')
+    sorted_values = values[order][zone_order].astype(np.float64)
+    starts = np.cumsum(counts) - counts
+    has_values = counts > 0
+    last = np.maximum(counts - 1, 0)
+    
+    for name, percentile in percentiles.items():
+        position = last * (percentile / 100)
+        lower = np.floor(position).astype(np.int64)
+        upper = np.minimum(lower + 1, last)
+        fraction = position - lower
+        below = np.where(has_values, starts + lower, 0)
+        above = np.where(has_values, starts + upper, 0)
+        if sorted_values.size:
+            value = sorted_values[below] + fraction * (sorted_values[above] - sorted_values[below])
+        else:
+            value = np.zeros(zone_count)
+        results[name] = np.where(has_values, value, np.nan)
+    
+    return results
+
+def compute_field_stats(tiff_file, zones, band=1):
+    """Return the zonal statistics of a TIFF band for every field, as zonal_statistics does.
+    
+    No-data pixels (NaN, nodata value or internal mask) are left out.
+    """
+    import rasterio
+    
+    with rasterio.open(tiff_file) as src:
+        window, labels = zones.labels(src)
+        if window is None:
+            return zonal_statistics([], [], len(zones))
+        
+        data = src.read(band, window=window)
+        valid = src.read_masks(band, window=window) > 0
+        if np.issubdtype(data.dtype, np.floating):
+            valid &= ~np.isnan(data)
+    
+    return zonal_statistics(data, np.where(valid, labels, 0), len(zones))
+
+def stats_rows(zones, date, index, stats):
+    """Yield one CSV row per field from a scene's statistics."""
+    for number, field_id in enumerate(zones.field_ids):
+        row = {'field_id': field_id, 'date': date, 'index': index}
+        for column in STAT_COLUMNS:
+            value = stats[column][number]
+            row[column] = int(value) if column == 'count' else ("" if np.isnan(value) else round(float(value), 6))
+        yield row
+
+def main():
+    """Main function to compute per-field statistics for all extracted GeoTIFF files."""
+    
+    parser = argparse.ArgumentParser(description='Compute per-field statistics of Sentinel-2 index rasters')
+    parser.add_argument('--fields', default=FIELDS_GEOJSON,
+                       help=f'GeoJSON file of the field polygons (default: {FIELDS_GEOJSON})')
+    parser.add_argument('--layers', nargs='+', default=list(ZONAL_LAYERS),
+                       help='Keywords selecting the layers to process (default: %(default)s)')
+    parser.add_argument('--output', default='field_statistics.csv',
+                       help='CSV file the statistics are written to (default: %(default)s)')
+    
+    args = parser.parse_args()
+    
+    print("Per-Field Zonal Statistics")
+    print("=" * 50)
+    
+    current_dir = Path.cwd()
+    tiff_dir = current_dir / "Browser_images (2)_clean"
+    
+    if not tiff_dir.exists():
+        print(f"Directory not found: {tiff_dir}")
+        print("Please run the rename script first to extract the TIFF files.")
+        return
+    
+    keywords = [keyword.upper() for keyword in args.layers]
+    tiff_files = [tiff_file for tiff_file in find_tiff_files(tiff_dir)
+                  if any(keyword in tiff_file.stem.upper() for keyword in keywords)]
+    
+    if not tiff_files:
+        print(f"No TIFF files matching {', '.join(args.layers)} found in {tiff_dir}")
+        return
+    
+    if not Path(args.fields).exists():
+        print(f"Field boundaries not found: {args.fields}")
+        return
+    
+    zones = FieldZones.from_geojson(args.fields)
+    print(f"Computing statistics of {len(zones)} fields over {len(tiff_files)} layers...")
+    
+    start = time.perf_counter()
+    scenes = 0
+    with open(args.output, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=['field_id', 'date', 'index', *STAT_COLUMNS])
+        writer.writeheader()
+        
+        for tiff_file in tiff_files:
+            date, index = parse_scene_name(tiff_file.stem)
+            try:
+                stats = compute_field_stats(tiff_file, zones)
+            except Exception as e:
+                print(f"❌ Error processing {tiff_file.name}: {e}")
+                continue
+            
+            writer.writerows(stats_rows(zones, date, index, stats))
+            scenes += 1
+            print(f"✅ {date or 'undated'} {index}: {int((stats['count'] > 0).sum())} of {len(zones)} fields with data")
+    
+    elapsed = time.perf_counter() - start
+    print(f"\n✅ Wrote statistics of {scenes} layers to {args.output} in {elapsed:.2f}s")
+
+if __name__ == "__main__":
+    main()